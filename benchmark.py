@@ -0,0 +1,242 @@
+"""Benchmarks of the bridge against the simulated DALI bus and an in-process MQTT broker."""
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+
+
+def bridge_config(args, workdir):
+    return {
+        "dali_driver": "dummy",
+        "dali_lamps": args.lamps,
+        "devices_names": os.path.join(workdir, "devices.yaml"),
+        "log_level": args.log_level,
+    }
+
+
+def start_bridge(args, workdir, client, driver):
+    """Run the bridge in a thread, return it and whether it went online in time."""
+    from src.dali2mqtt import main
+    from src.startup import StartupProfile
+
+    bridge = threading.Thread(target=main, args=(bridge_config(args, workdir), client, driver), daemon=True)
+    bridge.start()
+    return bridge, StartupProfile().online.wait(args.timeout)
+
+
+def scan_done(client):
+    """An event set once the bridge published that its scan is done, i.e. every lamp is served."""
+    from src.consts import DEFAULT_MQTT_BASE_TOPIC, MQTT_SCAN_PROGRESS_TOPIC, SCAN_STATE_DONE
+
+    done = threading.Event()
+    topic = MQTT_SCAN_PROGRESS_TOPIC.format(DEFAULT_MQTT_BASE_TOPIC)
+
+    def on_publish(message):
+        if message.topic == topic and json.loads(message.payload)["state"] == SCAN_STATE_DONE:
+            done.set()
+
+    client.add_listener(on_publish)
+    return done
+
+
+def run_startup(args):
+    """Time the bridge from process start to online, and fail when over budget."""
+    started = time.monotonic()
+    from src.loopback import LoopbackClient
+    from src.simulator import SimulatedDALIDriver
+    from src.startup import StartupProfile
+
+    profile = StartupProfile()
+    profile.start = started
+    profile.record("imports", started)
+
+    driver = SimulatedDALIDriver(args.lamps, args.frame_time)
+    client = LoopbackClient()
+    # The bridge is online from its first lamp, the scan phase ends once all of them were read
+    scanned = scan_done(client)
+    with tempfile.TemporaryDirectory() as workdir:
+        bridge, online = start_bridge(args, workdir, client, driver)
+        online = online and scanned.wait(args.timeout)
+        client.disconnect()
+        bridge.join(args.timeout)
+
+    result = json.loads(profile.as_json())
+    result.update({
+        "lamps": args.lamps,
+        "frame_time": args.frame_time,
+        "frames": driver.frames,
+        "budget": args.budget,
+        "passed": online and result["online_after"] <= args.budget,
+    })
+    print(json.dumps(result, indent=2))
+    return 0 if result["passed"] else 1
+
+
+def slider_workload(args):
+    """Brightness commands in quick succession on the first lamps, like dragging a slider."""
+    lamps = min(args.lamps, 4)
+    for index in itertools.count():
+        # Every value differs from the previous one of the same lamp, so each command changes something
+        level = str(20 + (index // lamps) * 7 % 200)
+        yield f"lamp_{index % lamps}", "brightness/set", level, "brightness/status", level
+
+
+def scene_workload(args):
+    """Scenes 0 and 1 called in turn on every lamp."""
+    for index in itertools.count():
+        scene = f"Scene {index // args.lamps % 2}"
+        yield f"lamp_{index % args.lamps}", "scene/set", scene, "scene/status", scene
+
+
+def bulk_workload(args):
+    """The group of all lamps switched on and off."""
+    for index in itertools.count():
+        level = "255" if index % 2 else "0"
+        yield "group_15", "brightness/set", level, "brightness/status", level
+
+
+WORKLOADS = {
+    "slider": slider_workload,
+    "scenes": scene_workload,
+    "bulk": bulk_workload,
+    # Slider commands while all lamps are polled over and over
+    "poll": slider_workload,
+}
+LOAD_POLL_PERIOD = 0.2
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+
+    def rank(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "max": values[-1]}
+
+
+def run_load(args):
+    """Drive a workload through MQTT and measure throughput, latencies and memory."""
+    tracemalloc.start()
+    import dali.address as address
+    import dali.gear.general as gear
+    from src.consts import DEFAULT_MQTT_BASE_TOPIC
+    from src.loopback import LoopbackClient
+    from src.simulator import SimulatedDALIDriver
+
+    driver = SimulatedDALIDriver(args.lamps, args.frame_time)
+    client = LoopbackClient()
+    lock = threading.Lock()
+    # Per device, the injection times of the commands still waiting for their frame, and for their state
+    waiting_frame = defaultdict(deque)
+    waiting_state = defaultdict(deque)
+    to_frame = []
+    to_state = []
+    done = threading.Event()
+    sent = [0]
+
+    def on_frame(command, at):
+        if not isinstance(command, (gear.DAPC, gear.GoToScene, gear.Off)):
+            return
+        destination = command.destination
+        if isinstance(destination, address.Short):
+            device = f"lamp_{destination.address}"
+        elif isinstance(destination, address.Group):
+            device = f"group_{destination.group}"
+        else:
+            return
+        with lock:
+            if waiting_frame[device]:
+                to_frame.append(at - waiting_frame[device].popleft())
+
+    def on_publish(message):
+        at = time.monotonic()
+        levels = message.topic.split("/")
+        device, state = levels[1], "/".join(levels[2:])
+        with lock:
+            pending = waiting_state.get(device)
+            if pending and pending[0][1] == state and pending[0][2] == message.payload:
+                to_state.append(at - pending.popleft()[0])
+                if len(to_state) == sent[0]:
+                    done.set()
+
+    # The bridge is online from its first lamp, the load starts once all of them were scanned
+    scanned = scan_done(client)
+    with tempfile.TemporaryDirectory() as workdir:
+        _, online = start_bridge(args, workdir, client, driver)
+        if not online or not scanned.wait(args.timeout):
+            print(json.dumps({"workload": args.workload, "error": "bridge not online"}))
+            return 1
+        driver.on_frame = on_frame
+        client.add_listener(on_publish)
+        frames = driver.frames
+
+        started = time.monotonic()
+        next_poll = started
+        commands = WORKLOADS[args.workload](args)
+        while time.monotonic() - started < args.duration:
+            device, command, payload, state, expected = next(commands)
+            with lock:
+                at = time.monotonic()
+                waiting_frame[device].append(at)
+                waiting_state[device].append((at, state, expected.encode("utf-8")))
+                sent[0] += 1
+            client.inject(f"{DEFAULT_MQTT_BASE_TOPIC}/{device}/{command}", payload)
+            if args.workload == "poll" and time.monotonic() >= next_poll:
+                client.inject(f"{DEFAULT_MQTT_BASE_TOPIC}/poll", "")
+                next_poll += LOAD_POLL_PERIOD
+            if args.rate:
+                time.sleep(max(started + sent[0] / args.rate - time.monotonic(), 0))
+        done.wait(args.timeout)
+        elapsed = time.monotonic() - started
+        client.disconnect()
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    with lock:
+        result = {
+            "workload": args.workload,
+            "lamps": args.lamps,
+            "frame_time": args.frame_time,
+            "rate": args.rate,
+            "duration": args.duration,
+            "commands": sent[0],
+            "completed": len(to_state),
+            "throughput": len(to_state) / elapsed,
+            "frames": driver.frames - frames,
+            "latency": {
+                "mqtt_to_frame": percentiles(to_frame),
+                "mqtt_to_state": percentiles(to_state),
+            },
+            "peak_memory": peak,
+        }
+    print(json.dumps(result, indent=2))
+    return 0 if result["completed"] == result["commands"] else 1
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--lamps", help="Number of simulated lamps", type=int, default=64)
+parser.add_argument("--frame-time", help="Seconds each simulated DALI frame takes", type=float, default=0.0005)
+parser.add_argument("--log-level", help="Log level of the bridge", default="warning")
+parser.add_argument("--timeout", help="Seconds before giving up", type=float, default=60)
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+startup = subparsers.add_parser("startup", help=run_startup.__doc__)
+startup.add_argument("--budget", help="Maximum seconds from start to online", type=float, default=3.0)
+startup.set_defaults(run=run_startup)
+
+load = subparsers.add_parser("load", help=run_load.__doc__)
+load.add_argument("--workload", help="Commands to send", choices=WORKLOADS, default="slider")
+load.add_argument("--rate", help="Commands per second, 0 for as fast as possible", type=float, default=50)
+load.add_argument("--duration", help="Seconds to send commands for", type=float, default=5)
+load.set_defaults(run=run_load)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    exit(args.run(args))
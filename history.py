@@ -0,0 +1,30 @@
+"""Print a range of the history recorded by the bridge, one JSON row per line."""
+import argparse
+import json
+import sqlite3
+import time
+
+from src.consts import HISTORY_QUERY_LIMIT
+from src.history import query
+
+
+def timestamp(value):
+    """Seconds since the epoch, or seconds ago when negative."""
+    value = float(value)
+    return time.time() + value if value < 0 else value
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("database", help="SQLite database of the history")
+parser.add_argument("--kind", help="Rows to print", choices=["levels", "events"], default="levels")
+parser.add_argument("--subject", help="Device of the levels, topic or bus state of the events")
+parser.add_argument("--since", help="Start timestamp, or seconds ago when negative", type=timestamp)
+parser.add_argument("--until", help="End timestamp, or seconds ago when negative", type=timestamp)
+parser.add_argument("--limit", help="Maximum number of rows", type=int, default=HISTORY_QUERY_LIMIT)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    # Read only, the bridge may be writing to it
+    db = sqlite3.connect(f"file:{args.database}?mode=ro", uri=True)
+    for row in query(db, args.kind, args.subject, args.since, args.until, args.limit):
+        print(json.dumps(row))
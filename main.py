@@ -1,10 +1,16 @@
-import os
+import time
+
+STARTED = time.monotonic()
 
-import yaml
+import os
 import argparse
 
 from src.consts import *
 from src.dali2mqtt import main
+from src.startup import StartupProfile
+
+StartupProfile().start = STARTED
+StartupProfile().record("imports", STARTED)
 
 logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
@@ -12,23 +18,26 @@ logger.setLevel(logging.INFO)
 
 
 def load_config_file(path, create):
-    """Load configuration from yaml file."""
+    """Load configuration from yaml file, raising ConfigError when it is invalid."""
+    # Only import yaml when there is a file to read or write
     try:
         with open(path, "r") as infile:
+            import yaml
+
             logger.info(f"Loading configuration from {path}")
             try:
                 configuration = yaml.safe_load(infile)
                 if not configuration:
-                    logger.error(f"Error during loading configuration file {path}")
-                    quit(1)
+                    raise ConfigError(f"Error during loading configuration file {path}")
                 config = CONF_SCHEMA(configuration)
-            except vol.MultipleInvalid as error:
-                logger.error(f"In configuration file {path}: {error}")
-                quit(1)
+            except (vol.MultipleInvalid, yaml.YAMLError) as error:
+                raise ConfigError(f"In configuration file {path}: {error}")
     except FileNotFoundError:
         if create:
             logger.info("No configuration file found, creating a new one")
             try:
+                import yaml
+
                 with open(path, "w", encoding="utf8") as outfile:
                     yaml.dump(CONF_SCHEMA({}), outfile, default_flow_style=False, allow_unicode=True)
             except Exception as err:
@@ -41,6 +50,28 @@ def load_config_file(path, create):
     return config
 
 
+def build_config(args):
+    """Configuration file, overridden by the D2M_ environment variables and the command line arguments."""
+    config = load_config_file(args[CONF_CONFIG], args[CONF_CONFIG_EXAMPLE])
+
+    for _x in os.environ:
+        if _x.startswith("D2M_"):
+            if _x[4:].lower() not in config:
+                raise ConfigError(f"Invalid env parameter {_x}")
+            if config.get(_x[4:].lower()) != os.environ[_x]:
+                if type(config[_x[4:].lower()]) is int:
+                    config[_x[4:].lower()] = int(os.environ[_x])
+                if type(config[_x[4:].lower()]) is bool:
+                    config[_x[4:].lower()] = bool(os.environ[_x])
+                else:
+                    config[_x[4:].lower()] = os.environ[_x]
+
+    for key in args:
+        if key not in (CONF_CONFIG, CONF_CONFIG_EXAMPLE) and config.get(key) != args[key]:
+            config[key] = args[key]
+    return config
+
+
 parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
 parser.add_argument(f"--{CONF_CONFIG}", help="configuration file", default=DEFAULT_CONFIG_FILE)
 parser.add_argument(
@@ -48,40 +79,80 @@ parser.add_argument(
     default=False
 )
 parser.add_argument(f"--{CONF_DEVICES_NAMES_FILE.replace('_', '-')}", help="devices names file")
+parser.add_argument(
+    f"--{CONF_DEVICES_NAMES_RELOAD_INTERVAL.replace('_', '-')}",
+    help="Seconds between checks of the devices names file, 0 to disable", type=int,
+)
+parser.add_argument(f"--{CONF_CONTROL_SOCKET.replace('_', '-')}", help="Path of the local control socket")
 parser.add_argument(f"--{CONF_MQTT_SERVER.replace('_', '-')}", help="MQTT server")
 parser.add_argument(f"--{CONF_MQTT_PORT.replace('_', '-')}", help="MQTT port", type=int)
 parser.add_argument(f"--{CONF_MQTT_USERNAME.replace('_', '-')}", help="MQTT username")
 parser.add_argument(f"--{CONF_MQTT_PASSWORD.replace('_', '-')}", help="MQTT password")
 parser.add_argument(f"--{CONF_MQTT_BASE_TOPIC.replace('_', '-')}", help="MQTT base topic")
+parser.add_argument(
+    f"--{CONF_MQTT_PROTOCOL.replace('_', '-')}", help="MQTT protocol version", choices=ALL_SUPPORTED_MQTT_PROTOCOLS,
+)
 parser.add_argument(f"--{CONF_DALI_DRIVER.replace('_', '-')}", help="DALI device driver", choices=DALI_DRIVERS, )
 parser.add_argument(f"--{CONF_DALI_LAMPS.replace('_', '-')}", help="Number of lamps to scan", type=int, )
+parser.add_argument(
+    f"--{CONF_DALI_PIPELINE_DEPTH.replace('_', '-')}", help="Number of queries in flight at once", type=int,
+)
+parser.add_argument(f"--{CONF_DALI_SERVER_HOST.replace('_', '-')}", help="daliserver host")
+parser.add_argument(f"--{CONF_DALI_SERVER_PORT.replace('_', '-')}", help="daliserver port", type=int)
+parser.add_argument(
+    f"--{CONF_DALI_TRANSACTION_TIMEOUT.replace('_', '-')}",
+    help="Maximum seconds before a DALI transaction is given up",
+    type=float,
+)
+parser.add_argument(
+    f"--{CONF_BUS_BACKGROUND_SHARE.replace('_', '-')}", help="Percentage of bus time for polls and scans", type=int,
+)
 parser.add_argument(f"--{CONF_HA_DISCOVERY_PREFIX.replace('_', '-')}", help="HA discovery mqtt prefix", )
 parser.add_argument(f"--{CONF_LOG_LEVEL.replace('_', '-')}", help="Log level", choices=ALL_SUPPORTED_LOG_LEVELS, )
 parser.add_argument(f"--{CONF_LOG_COLOR.replace('_', '-')}", help="Coloring output", action="store_true", )
 parser.add_argument(f"--{CONF_GROUP_MODE.replace('_', '-')}", help="Group mode", choices=ALL_SUPPORTED_GROUP_MODES,)
+parser.add_argument(
+    f"--{CONF_POLL_INTERVAL.replace('_', '-')}", help="Seconds between polls of all lamps, 0 to disable", type=int,
+)
+parser.add_argument(
+    f"--{CONF_PROBE_INTERVAL.replace('_', '-')}", help="Seconds between status probes of the bus, 0 to disable",
+    type=int,
+)
+parser.add_argument(
+    f"--{CONF_WARM_START.replace('_', '-')}", help="Start from the retained state of the lamps", action="store_true",
+)
+parser.add_argument(
+    f"--{CONF_SHARD_ID.replace('_', '-')}", help="Id of this bridge among the ones sharing the DALI line",
+)
+parser.add_argument(
+    f"--{CONF_STATE_DELTAS.replace('_', '-')}", help="Also publish the changes of the state snapshot",
+    action="store_true",
+)
+parser.add_argument(
+    f"--{CONF_OFFLINE_BUFFER_SIZE.replace('_', '-')}", help="KB kept while the MQTT server is unreachable",
+    type=int,
+)
+parser.add_argument(f"--{CONF_HISTORY_DB.replace('_', '-')}", help="SQLite database of the history, none by default")
+parser.add_argument(
+    f"--{CONF_HISTORY_MAX_SIZE.replace('_', '-')}", help="Size of the history database in MB", type=int,
+)
+parser.add_argument(
+    f"--{CONF_ADMIN_PROFILING.replace('_', '-')}", help="Allow profiling sessions over MQTT", action="store_true",
+)
+parser.add_argument(f"--{CONF_PROFILE_DIR.replace('_', '-')}", help="Directory profiling reports can be written to")
+parser.add_argument(
+    f"--{CONF_PROFILE_STARTUP.replace('_', '-')}", help="Report the startup timings", action="store_true",
+)
 
 args = parser.parse_args()
 args = vars(args)
 
-CONFIG = load_config_file(args[CONF_CONFIG], args[CONF_CONFIG_EXAMPLE])
-
-for _x in os.environ:
-    if _x.startswith("D2M_"):
-        if _x[4:].lower() not in CONFIG:
-            logger.error(f"Invalid env parameter {_x}")
-            exit(1)
-        if CONFIG.get(_x[4:].lower()) != os.environ[_x]:
-            if type(CONFIG[_x[4:].lower()]) is int:
-                CONFIG[_x[4:].lower()] = int(os.environ[_x])
-            if type(CONFIG[_x[4:].lower()]) is bool:
-                CONFIG[_x[4:].lower()] = bool(os.environ[_x])
-            else:
-                CONFIG[_x[4:].lower()] = os.environ[_x]
-
-args.pop(CONF_CONFIG)
-args.pop(CONF_CONFIG_EXAMPLE)
-for key in args:
-    if CONFIG.get(key) != args[key]:
-        CONFIG[key] = args[key]
-
-main(CONFIG)
+started = time.monotonic()
+try:
+    CONFIG = build_config(args)
+except ConfigError as err:
+    logger.error(err)
+    exit(1)
+StartupProfile().record("config load", started)
+
+main(CONFIG, load_config=lambda: build_config(args))
@@ -0,0 +1,67 @@
+"""Health of the control gear at each short address."""
+import threading
+import time
+
+from .config import Config
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class AddressHealth:
+    """Circuit breaker per short address, so broken gear stops eating bus time.
+
+    Every failure (no answer, a collision or an error) doubles the time
+    before the address is queried again, starting at ADDRESS_BACKOFF_BASE. After ADDRESS_QUARANTINE_FAILURES
+    failures in a row the address is quarantined: it is only reprobed every
+    ADDRESS_BACKOFF_MAX seconds. One answer resets it.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(AddressHealth, cls).__new__(cls)
+            cls._instance.config = Config()
+            cls._instance._lock = threading.Lock()
+            cls._instance._failures = {}
+            logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[cls._instance.config[CONF_LOG_LEVEL]])
+        return cls._instance
+
+    def available(self, address):
+        """Whether the address may be queried now."""
+        with self._lock:
+            failure = self._failures.get(address)
+            return failure is None or time.monotonic() >= failure[1]
+
+    def quarantined(self, address):
+        with self._lock:
+            failure = self._failures.get(address)
+            return failure is not None and failure[0] >= ADDRESS_QUARANTINE_FAILURES
+
+    def succeeded(self, address):
+        with self._lock:
+            failure = self._failures.pop(address, None)
+        if failure is not None and failure[0] >= ADDRESS_QUARANTINE_FAILURES:
+            logger.info(f"Lamp {address} answers again, leaving quarantine")
+
+    def failed(self, address):
+        with self._lock:
+            count = self._failures.get(address, (0, 0))[0] + 1
+            if count >= ADDRESS_QUARANTINE_FAILURES:
+                backoff = ADDRESS_BACKOFF_MAX
+            else:
+                backoff = min(ADDRESS_BACKOFF_BASE * 2 ** (count - 1), ADDRESS_BACKOFF_MAX)
+            self._failures[address] = (count, time.monotonic() + backoff)
+        if count == ADDRESS_QUARANTINE_FAILURES:
+            logger.warning(f"Lamp {address} failed {count} times in a row, quarantining it")
+        else:
+            logger.debug(f"Lamp {address} failed {count} times, next query in {backoff}s")
+
+    def check(self, address, response):
+        """Record the outcome of a query answered with response, and tell whether it can be used."""
+        if isinstance(response, Exception) or response.raw_value is None or response.raw_value.error:
+            self.failed(address)
+            return False
+        self.succeeded(address)
+        return True
@@ -0,0 +1,295 @@
+"""Shared access to the DALI driver."""
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import dali.address as address
+import dali.gear.general as gear
+from dali.exceptions import DALIError
+
+from .config import Config
+from .consts import *
+from .timing import BusTiming
+from .transaction import unlocked
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class BusScheduler:
+    """Grant the bus to the most urgent waiting transaction.
+
+    A transaction only gets the bus when no transaction of a higher priority
+    class is waiting. Background classes are additionally held back while
+    they have used more than their share of the bus in the last
+    BUS_SHARE_WINDOW seconds.
+    """
+
+    def __init__(self, background_share):
+        self.background_share = background_share
+        self._cond = threading.Condition()
+        self._busy = False
+        self._waiting = [deque() for _ in ALL_BUS_PRIORITIES]
+        self._usage = {priority: deque() for priority in BACKGROUND_BUS_PRIORITIES}
+
+    @contextmanager
+    def acquire(self, priority):
+        """Wait for the bus, in the order of the requests within a class.
+
+        The state transaction of the caller lets the others run meanwhile,
+        the order of their frames still follows the order of their changes.
+        """
+        turn = object()
+        with self._cond:
+            self._waiting[priority].append(turn)
+        with unlocked():
+            with self._cond:
+                try:
+                    while (self._busy or self._waiting[priority][0] is not turn
+                           or any(self._waiting[:priority]) or self._over_share(priority)):
+                        self._cond.wait(BUS_SHARE_RECHECK)
+                finally:
+                    self._waiting[priority].remove(turn)
+                    self._cond.notify_all()
+                self._busy = True
+
+            start = time.monotonic()
+            try:
+                yield
+            finally:
+                end = time.monotonic()
+                with self._cond:
+                    self._busy = False
+                    if priority in self._usage:
+                        self._usage[priority].append((end, end - start))
+                    self._cond.notify_all()
+
+    def _over_share(self, priority):
+        usage = self._usage.get(priority)
+        if not usage:
+            return False
+        since = time.monotonic() - BUS_SHARE_WINDOW
+        while usage and usage[0][0] < since:
+            usage.popleft()
+        return sum(duration for _, duration in usage) > BUS_SHARE_WINDOW * self.background_share / 100
+
+
+class BusTimeoutError(DALIError):
+    """The driver did not finish a transaction before its deadline."""
+
+
+class BusUnavailableError(DALIError):
+    """The driver failed and has not been reopened yet."""
+
+
+class _Transactor:
+    """Thread calling the driver, so a caller can give up on a call that hangs.
+
+    A transactor whose call timed out is abandoned with the driver it was
+    using, the thread stays blocked in that call until the process ends.
+    """
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        threading.Thread(target=self._run, name="dali-bus", daemon=True).start()
+
+    def _run(self):
+        while True:
+            function, done, result = self._jobs.get()
+            try:
+                result.append((True, function()))
+            except Exception as err:
+                result.append((False, err))
+            done.set()
+
+    def call(self, function, timeout):
+        done = threading.Event()
+        result = []
+        self._jobs.put((function, done, result))
+        if not done.wait(timeout):
+            raise BusTimeoutError(f"no answer from the driver within {timeout:.2f}s")
+        ok, value = result[0]
+        if ok:
+            return value
+        raise value
+
+
+def _close(driver):
+    """Release the device or connection of a driver which is replaced, as far as it can be."""
+    for target in (driver, getattr(driver, "device", None), getattr(driver, "backend", None)):
+        close = getattr(target, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception as err:
+                logger.debug(f"Failed to close the DALI driver: {err}")
+            return
+
+
+class Bus:
+    """Wrap a DALI driver so several threads can send on it.
+
+    Every transaction is tagged with one of the BUS_PRIORITY_* classes and
+    scheduled on its own, so a user command only waits for the frame in
+    progress instead of a whole poll or scan.
+
+    The driver is called with a deadline per frame which timing tunes from
+    the measured latencies, up to dali_transaction_timeout. A transaction
+    missing it fails with BusTimeoutError and the deadline is raised, the
+    driver may only have been slow. A driver missing BUS_TIMING_MISSES
+    deadlines in a row or dali_transaction_timeout, or failing with
+    anything but a DALIError, is considered wedged or unplugged:
+    transactions fail at once with BusUnavailableError while the
+    driver is closed and reopened with reopen() in the background, or probed
+    until it answers again without reopen(), then on_recovered() is called
+    to replay the state. Every change of the health is passed to
+    on_health(status), the tuned timing to on_timing(status) when it changed.
+    Drivers with a pacing attribute get the tuned gap between the frames of
+    their batches.
+    """
+
+    def __init__(self, driver, reopen=None):
+        self.config = Config()
+        logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
+
+        self.driver = driver
+        self.reopen = reopen
+        self.on_recovered = None
+        self.on_health = None
+        self.on_timing = None
+        self.pipeline_depth = self.config[CONF_DALI_PIPELINE_DEPTH]
+        self.timing = BusTiming(self.config[CONF_DALI_TRANSACTION_TIMEOUT])
+        self.scheduler = BusScheduler(self.config[CONF_BUS_BACKGROUND_SHARE])
+        self.health = {"state": BUS_STATE_OK, "timeouts": 0, "errors": 0, "reopens": 0, "last_error": None}
+        self._transactor = _Transactor()
+        self._recovering = False
+
+    def send(self, command, priority=BUS_PRIORITY_COMMAND):
+        with self.scheduler.acquire(priority):
+            return self._transact(lambda: self.driver.send(command), [command])
+
+    def send_sequence(self, commands, priority=BUS_PRIORITY_COMMAND):
+        """Send commands back to back, e.g. DTR0 and the command using it, without other traffic in between."""
+        with self.scheduler.acquire(priority):
+            return self._transact(lambda: [self.driver.send(command) for command in commands], commands)
+
+    def _transact(self, function, commands):
+        """Call function sending commands on the driver thread, within the deadline of their frames."""
+        if self.health["state"] != BUS_STATE_OK:
+            raise BusUnavailableError(f"DALI driver is {self.health['state']}: {self.health['last_error']}")
+        self.timing.pace()
+        started = time.monotonic()
+        try:
+            result = self._transactor.call(function, self.timing.deadline(commands))
+        except BusTimeoutError as err:
+            at_most = self.timing.timeout >= self.timing.max_timeout
+            self.timing.timed_out()
+            if at_most or self.timing.misses >= BUS_TIMING_MISSES:
+                self._failed("timeouts", err)
+            else:
+                # The late call still runs ahead of the next transaction, which misses its deadline too if it hangs
+                logger.warning(f"DALI transaction given up, waiting longer from now on: {err}")
+            raise
+        except DALIError:
+            self.timing.frame_error()
+            raise
+        except Exception as err:
+            self._failed("errors", err)
+            raise BusUnavailableError(f"DALI driver failed: {err}") from err
+
+        self.timing.record(commands, result if isinstance(result, list) else [result], time.monotonic() - started)
+        if hasattr(self.driver, "pacing"):
+            self.driver.pacing = self.timing.gap
+        status = self.timing.report()
+        if status is not None and self.on_timing is not None:
+            try:
+                self.on_timing(self.status())
+            except Exception as err:
+                logger.error(f"Failed to report the bus timing: {err}")
+        return result
+
+    def status(self):
+        """Health and tuned timing of the bus."""
+        return dict(self.health, timing=self.timing.status())
+
+    def _failed(self, counter, err):
+        logger.error(f"DALI driver failed, reopening it: {err}")
+        self.health[counter] += 1
+        self.health["last_error"] = str(err)
+        self._set_state(BUS_STATE_RECOVERING)
+        if not self._recovering:
+            self._recovering = True
+            threading.Thread(target=self._recover, name="dali-bus-recovery", daemon=True).start()
+
+    def _recover(self):
+        """Reopen the driver until it works again, then let the state be replayed."""
+        if self.reopen is not None:
+            _close(self.driver)
+        while True:
+            try:
+                if self.reopen is not None:
+                    transactor = _Transactor()
+                    driver = transactor.call(self.reopen, BUS_REOPEN_TIMEOUT)
+                    if driver is None:
+                        raise BusUnavailableError("no driver")
+                else:
+                    # Nothing to reopen: probe the same driver, on its own thread as it may still be stuck there
+                    driver, transactor = self.driver, self._transactor
+                    transactor.call(
+                        lambda: driver.send(gear.QueryControlGearPresent(address.Broadcast())), BUS_REOPEN_TIMEOUT
+                    )
+            except Exception as err:
+                logger.error(f"Failed to reopen the DALI driver: {err}")
+                self.health["last_error"] = str(err)
+                self._set_state(BUS_STATE_FAILED)
+            else:
+                break
+            time.sleep(BUS_REOPEN_INTERVAL)
+
+        # Wait for the transaction in progress, if any, before swapping the driver
+        with self.scheduler.acquire(BUS_PRIORITY_COMMAND):
+            self.driver = driver
+            self._transactor = transactor
+            self.health["reopens"] += 1
+            self.timing.misses = 0
+            self._recovering = False
+            self._set_state(BUS_STATE_OK)
+        logger.info("DALI driver reopened")
+        if self.on_recovered is not None:
+            self.on_recovered()
+
+    def _set_state(self, state):
+        self.health["state"] = state
+        if self.on_health is not None:
+            try:
+                self.on_health(self.status())
+            except Exception as err:
+                logger.error(f"Failed to report the bus health: {err}")
+
+    def query_many(self, commands, priority=BUS_PRIORITY_READBACK, return_exceptions=False):
+        """Send independent queries and return their responses in the same order.
+
+        Drivers providing send_many(commands) get up to pipeline_depth queries
+        in flight at once, the others are sent one by one. With
+        return_exceptions a failed query gives its DALIError in place of a
+        response instead of aborting the remaining ones.
+        """
+        depth = self.pipeline_depth if hasattr(self.driver, "send_many") else 1
+
+        responses = []
+        for start in range(0, len(commands), depth):
+            chunk = commands[start:start + depth]
+            try:
+                if depth > 1:
+                    with self.scheduler.acquire(priority):
+                        responses.extend(self._transact(lambda: self.driver.send_many(chunk), chunk))
+                else:
+                    responses.append(self.send(chunk[0], priority))
+            except DALIError as err:
+                if not return_exceptions:
+                    raise
+                logger.debug("Query failed: %s", err)
+                responses.extend([err] * len(chunk))
+        return responses
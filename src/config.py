@@ -20,6 +20,22 @@ class Config:
         self._done_setup = True
         self._config = CONF_SCHEMA(config)
 
+    def reload(self, config):
+        """Validate config and apply the RELOADABLE_CONFIG keys which changed, returning them."""
+        self._did_setup()
+        config = CONF_SCHEMA(config)
+        changed = {}
+        for key, value in config.items():
+            if value == self._config.get(key):
+                continue
+            if key in RELOADABLE_CONFIG:
+                changed[key] = value
+            else:
+                logger.warning(f"{key} can only be changed by restarting")
+        # Swapped at once, readers see either the old or the new configuration
+        self._config = {**self._config, **changed}
+        return changed
+
     def _did_setup(self):
         if not self._done_setup:
             raise SetupError("Class was not setup properly.")
@@ -49,3 +65,11 @@ class Config:
             self._config.get(CONF_MQTT_PASSWORD, DEFAULT_MQTT_PASSWORD),
             self._config[CONF_MQTT_BASE_TOPIC],
         )
+
+    @property
+    def availability_topic(self):
+        """Topic telling whether the bridge is online, one per shard when sharded."""
+        self._did_setup()
+        if self._config[CONF_SHARD_ID]:
+            return MQTT_SHARD_STATUS_TOPIC.format(self._config[CONF_MQTT_BASE_TOPIC], self._config[CONF_SHARD_ID])
+        return MQTT_DALI2MQTT_STATUS.format(self._config[CONF_MQTT_BASE_TOPIC])
@@ -7,38 +7,96 @@ VERSION = "0.1.0"
 
 HASSEB = "hasseb"
 MIN_HASSEB_FIRMWARE_VERSION = 2.3
+HASSEB_FRAME_INTERVAL = 0.01
+# After a frame without answer, which is still on the bus when written to the adapter
+HASSEB_COMMAND_INTERVAL = 0.02
+HASSEB_READ_ATTEMPTS = 200
 TRIDONIC = "tridonic"
 DALI_SERVER = "dali_server"
-DALI_DRIVERS = [HASSEB, TRIDONIC, DALI_SERVER, "dummy"]
+DUMMY = "dummy"
+DALI_DRIVERS = [HASSEB, TRIDONIC, DALI_SERVER, DUMMY]
+SIMULATOR_FRAME_TIME = 0.025
 
 CONF_CONFIG = "config"
 CONF_CONFIG_EXAMPLE = "config_example"
 CONF_DEVICES_NAMES_FILE = "devices_names"
+CONF_DEVICES_NAMES_RELOAD_INTERVAL = "devices_names_reload_interval"
+CONF_CONTROL_SOCKET = "control_socket"
 CONF_MQTT_SERVER = "mqtt_server"
 CONF_MQTT_PORT = "mqtt_port"
 CONF_MQTT_USERNAME = "mqtt_username"
 CONF_MQTT_PASSWORD = "mqtt_password"
 CONF_MQTT_BASE_TOPIC = "mqtt_base_topic"
+CONF_MQTT_PROTOCOL = "mqtt_protocol"
 CONF_DALI_DRIVER = "dali_driver"
 CONF_DALI_LAMPS = "dali_lamps"
+CONF_DALI_PIPELINE_DEPTH = "dali_pipeline_depth"
+CONF_DALI_SERVER_HOST = "dali_server_host"
+CONF_DALI_SERVER_PORT = "dali_server_port"
+CONF_DALI_TRANSACTION_TIMEOUT = "dali_transaction_timeout"
 CONF_HA_DISCOVERY_PREFIX = "ha_discovery_prefix"
+CONF_BUS_BACKGROUND_SHARE = "bus_background_share"
 CONF_LOG_LEVEL = "log_level"
 CONF_LOG_COLOR = "log_color"
 CONF_GROUP_MODE = "group_mode"
+CONF_POLL_INTERVAL = "poll_interval"
+CONF_PROBE_INTERVAL = "probe_interval"
+CONF_WARM_START = "warm_start"
+CONF_SHARD_ID = "shard_id"
+CONF_PROFILE_STARTUP = "profile_startup"
+CONF_ADMIN_PROFILING = "admin_profiling"
+CONF_PROFILE_DIR = "profile_dir"
+CONF_STATE_DELTAS = "state_deltas"
+CONF_HISTORY_DB = "history_db"
+CONF_HISTORY_MAX_SIZE = "history_max_size"
+CONF_OFFLINE_BUFFER_SIZE = "offline_buffer_size"
+
+# Applied by a reload, the others need a restart
+RELOADABLE_CONFIG = [
+    CONF_LOG_LEVEL,
+    CONF_GROUP_MODE,
+    CONF_POLL_INTERVAL,
+    CONF_PROBE_INTERVAL,
+    CONF_BUS_BACKGROUND_SHARE,
+    CONF_DALI_TRANSACTION_TIMEOUT,
+    CONF_STATE_DELTAS,
+    CONF_PROFILE_DIR,
+    CONF_HISTORY_MAX_SIZE,
+    CONF_OFFLINE_BUFFER_SIZE,
+]
 
 DEFAULT_CONFIG_FILE = "config.yaml"
 DEFAULT_DEVICES_NAMES_FILE = "devices.yaml"
+DEFAULT_DEVICES_NAMES_RELOAD_INTERVAL = 5
+DEFAULT_CONTROL_SOCKET = ""
 DEFAULT_MQTT_SERVER = "localhost"
 DEFAULT_MQTT_PORT = "1883"
 DEFAULT_MQTT_USERNAME = ""
 DEFAULT_MQTT_PASSWORD = ""
 DEFAULT_MQTT_BASE_TOPIC = "dali2mqtt"
+DEFAULT_MQTT_PROTOCOL = "3.1.1"
 DEFAULT_DALI_DRIVER = "hasseb"
 DEFAULT_DALI_LAMPS = 64
+DEFAULT_DALI_PIPELINE_DEPTH = 1
+DEFAULT_DALI_SERVER_HOST = "localhost"
+DEFAULT_DALI_SERVER_PORT = 55825
+DEFAULT_DALI_TRANSACTION_TIMEOUT = 2.0
 DEFAULT_HA_DISCOVERY_PREFIX = "homeassistant"
+DEFAULT_BUS_BACKGROUND_SHARE = 80
 DEFAULT_LOG_LEVEL = "info"
 DEFAULT_LOG_COLOR = False
 DEFAULT_GROUP_MODE = "mean"
+DEFAULT_POLL_INTERVAL = 0
+DEFAULT_PROBE_INTERVAL = 0
+DEFAULT_WARM_START = False
+DEFAULT_SHARD_ID = ""
+DEFAULT_PROFILE_STARTUP = False
+DEFAULT_ADMIN_PROFILING = False
+DEFAULT_PROFILE_DIR = ""
+DEFAULT_STATE_DELTAS = False
+DEFAULT_HISTORY_DB = ""
+DEFAULT_HISTORY_MAX_SIZE = 100
+DEFAULT_OFFLINE_BUFFER_SIZE = 1024
 
 ALL_SUPPORTED_LOG_LEVELS = {
     "critical": logging.CRITICAL,
@@ -50,6 +108,96 @@ ALL_SUPPORTED_LOG_LEVELS = {
 
 ALL_SUPPORTED_GROUP_MODES = ["mean", "max", "min", "off"]
 
+MQTT_PROTOCOL_V311 = "3.1.1"
+MQTT_PROTOCOL_V5 = "5"
+ALL_SUPPORTED_MQTT_PROTOCOLS = [MQTT_PROTOCOL_V311, MQTT_PROTOCOL_V5]
+
+# Bus priority classes, most urgent first
+BUS_PRIORITY_COMMAND = 0
+BUS_PRIORITY_READBACK = 1
+BUS_PRIORITY_POLL = 2
+BUS_PRIORITY_SCAN = 3
+ALL_BUS_PRIORITIES = [BUS_PRIORITY_COMMAND, BUS_PRIORITY_READBACK, BUS_PRIORITY_POLL, BUS_PRIORITY_SCAN]
+BACKGROUND_BUS_PRIORITIES = [BUS_PRIORITY_POLL, BUS_PRIORITY_SCAN]
+BUS_SHARE_WINDOW = 1.0
+BUS_SHARE_RECHECK = 0.01
+
+# Seconds idle before TCP keepalive probes, between them, and probes lost before the connection is dropped
+DALI_SERVER_KEEPALIVE_IDLE = 30
+DALI_SERVER_KEEPALIVE_INTERVAL = 10
+DALI_SERVER_KEEPALIVE_COUNT = 3
+
+# Bus watchdog
+BUS_STATE_OK = "ok"
+BUS_STATE_RECOVERING = "recovering"
+BUS_STATE_FAILED = "failed"
+BUS_REOPEN_INTERVAL = 5
+BUS_REOPEN_TIMEOUT = 10
+
+# Bus timing tuning, seconds
+BUS_TIMING_MIN_SAMPLES = 20
+# At worst a forward frame (17 ms), the settling before the answer (10.5 ms), the answer or the wait for it (up to
+# 22 ms) and the settling before the next frame (18 ms) take about 70 ms on the bus, the adapter, USB polling and the
+# network come on top
+BUS_TIMING_MIN_TIMEOUT = 0.5
+BUS_TIMING_TIMEOUT_FACTOR = 3
+BUS_TIMING_TIMEOUT_STEP = 0.01
+BUS_TIMING_BACKOFF = 4
+# Deadlines missed in a row before the driver is taken as wedged, unless it was at dali_transaction_timeout already
+BUS_TIMING_MISSES = 2
+BUS_TIMING_GAP_STEP = 0.002
+BUS_TIMING_MAX_GAP = 0.1
+BUS_TIMING_CLEAN_FRAMES = 50
+BUS_TIMING_REPORT_INTERVAL = 60
+
+# Warm start and background polling, the retained state is awaited at most WARM_START_WINDOW seconds
+WARM_START_WINDOW = 0.5
+# Entries of a lamp in the retained inventory which spare reading it
+WARM_START_PARAMETERS = {"address", "physical_minimum", "min_level", "max_level", "fade_time", "scenes", "groups"}
+POLL_CHUNK_SIZE = 8
+POLL_VERIFY_PAUSE = 1.0
+
+CONTROL_SOCKET_MODE = 0o660
+# Subject of the commands received on the control socket in the history
+CONTROL_HISTORY_SUBJECT = "control"
+
+SNAPSHOT_DEBOUNCE = 0.2
+
+# Brightness commands on lamps are gathered this long, so scene calls can set them together
+COALESCE_WINDOW = 0.02
+
+PROFILE_MODES = ["cprofile", "sample", "tracemalloc"]
+PROFILE_DEFAULT_DURATION = 10
+PROFILE_MAX_DURATION = 300
+PROFILE_DEFAULT_TOP = 40
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+HISTORY_FLUSH_INTERVAL = 1.0
+HISTORY_QUEUE_SIZE = 10000
+HISTORY_MAINTENANCE_INTERVAL = 3600
+HISTORY_DOWNSAMPLE_AGE = 86400
+HISTORY_DOWNSAMPLE_BUCKET = 60
+HISTORY_RETENTION_CHUNK = 1000
+HISTORY_QUERY_LIMIT = 1000
+
+OFFLINE_MESSAGE_EXPIRY = 30
+
+# Sharding
+MQTT_CLIENT_ID = "dali2mqttx"
+MQTT_SHARD_CLIENT_ID = "dali2mqtt-{}"
+SHARD_CLAIM_DELAY = 1.0
+
+# MQTT v5
+MQTT_ALIASED_TOPICS_SUFFIX = "/status"
+MQTT_CORRELATION_PROPERTY = "correlation_id"
+
+# Per address circuit breaker
+ADDRESS_BACKOFF_BASE = 10
+ADDRESS_BACKOFF_MAX = 600
+ADDRESS_QUARANTINE_FAILURES = 3
+
+TRANSITION_STEP_INTERVAL = 0.25
+
 RESET_COLOR = "\x1b[0m"
 RED_COLOR = "\x1b[31;21m"
 YELLOW_COLOR = "\x1b[33;21m"
@@ -64,6 +212,9 @@ CONF_SCHEMA = vol.Schema(
         vol.Optional(CONF_MQTT_USERNAME, default=DEFAULT_MQTT_USERNAME): str,
         vol.Optional(CONF_MQTT_PASSWORD, default=DEFAULT_MQTT_PASSWORD): str,
         vol.Optional(CONF_MQTT_BASE_TOPIC, default=DEFAULT_MQTT_BASE_TOPIC): str,
+        vol.Optional(CONF_MQTT_PROTOCOL, default=DEFAULT_MQTT_PROTOCOL): vol.All(
+            vol.Coerce(str), vol.In(ALL_SUPPORTED_MQTT_PROTOCOLS)
+        ),
 
         vol.Required(CONF_DALI_DRIVER, default=DEFAULT_DALI_DRIVER): vol.In(
             DALI_DRIVERS
@@ -71,10 +222,27 @@ CONF_SCHEMA = vol.Schema(
         vol.Optional(CONF_DALI_LAMPS, default=DEFAULT_DALI_LAMPS): vol.All(
             vol.Coerce(int), vol.Range(min=1, max=64)
         ),
+        vol.Optional(CONF_DALI_PIPELINE_DEPTH, default=DEFAULT_DALI_PIPELINE_DEPTH): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=64)
+        ),
+        vol.Optional(CONF_DALI_SERVER_HOST, default=DEFAULT_DALI_SERVER_HOST): str,
+        vol.Optional(CONF_DALI_SERVER_PORT, default=DEFAULT_DALI_SERVER_PORT): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=65535)
+        ),
+        vol.Optional(CONF_DALI_TRANSACTION_TIMEOUT, default=DEFAULT_DALI_TRANSACTION_TIMEOUT): vol.All(
+            vol.Coerce(float), vol.Range(min=0.1)
+        ),
+        vol.Optional(CONF_BUS_BACKGROUND_SHARE, default=DEFAULT_BUS_BACKGROUND_SHARE): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=100)
+        ),
         vol.Optional(
             CONF_HA_DISCOVERY_PREFIX, default=DEFAULT_HA_DISCOVERY_PREFIX
         ): str,
         vol.Optional(CONF_DEVICES_NAMES_FILE, default=DEFAULT_DEVICES_NAMES_FILE): str,
+        vol.Optional(CONF_DEVICES_NAMES_RELOAD_INTERVAL, default=DEFAULT_DEVICES_NAMES_RELOAD_INTERVAL): vol.All(
+            vol.Coerce(int), vol.Range(min=0)
+        ),
+        vol.Optional(CONF_CONTROL_SOCKET, default=DEFAULT_CONTROL_SOCKET): str,
         vol.Optional(CONF_LOG_LEVEL, default=DEFAULT_LOG_LEVEL): vol.In(
             ALL_SUPPORTED_LOG_LEVELS
         ),
@@ -82,11 +250,32 @@ CONF_SCHEMA = vol.Schema(
         vol.Optional(CONF_GROUP_MODE, default=DEFAULT_GROUP_MODE): vol.In(
             ALL_SUPPORTED_GROUP_MODES
         ),
+        vol.Optional(CONF_POLL_INTERVAL, default=DEFAULT_POLL_INTERVAL): vol.All(
+            vol.Coerce(int), vol.Range(min=0)
+        ),
+        vol.Optional(CONF_PROBE_INTERVAL, default=DEFAULT_PROBE_INTERVAL): vol.All(
+            vol.Coerce(int), vol.Range(min=0)
+        ),
+        vol.Optional(CONF_WARM_START, default=DEFAULT_WARM_START): bool,
+        vol.Optional(CONF_SHARD_ID, default=DEFAULT_SHARD_ID): vol.Match(r"^[A-Za-z0-9_-]*$"),
+        vol.Optional(CONF_PROFILE_STARTUP, default=DEFAULT_PROFILE_STARTUP): bool,
+        vol.Optional(CONF_ADMIN_PROFILING, default=DEFAULT_ADMIN_PROFILING): bool,
+        vol.Optional(CONF_PROFILE_DIR, default=DEFAULT_PROFILE_DIR): str,
+        vol.Optional(CONF_STATE_DELTAS, default=DEFAULT_STATE_DELTAS): bool,
+        vol.Optional(CONF_HISTORY_DB, default=DEFAULT_HISTORY_DB): str,
+        vol.Optional(CONF_HISTORY_MAX_SIZE, default=DEFAULT_HISTORY_MAX_SIZE): vol.All(
+            vol.Coerce(int), vol.Range(min=1)
+        ),
+        vol.Optional(CONF_OFFLINE_BUFFER_SIZE, default=DEFAULT_OFFLINE_BUFFER_SIZE): vol.All(
+            vol.Coerce(int), vol.Range(min=1)
+        ),
     },
     extra=False,
 )
 
 MQTT_DALI2MQTT_STATUS = "{}/status"
+MQTT_SHARD_STATUS_TOPIC = "{}/shards/{}/status"
+MQTT_SHARD_OWNER_TOPIC = "{}/bridge/owner"
 MQTT_STATE_TOPIC = "{}/{}/status"
 MQTT_COMMAND_TOPIC = "{}/{}/set"
 MQTT_FLASH_TOPIC = "{}/{}/flash"
@@ -95,25 +284,57 @@ MQTT_BRIGHTNESS_COMMAND_TOPIC = "{}/{}/brightness/set"
 MQTT_SCENE_STATE_TOPIC = "{}/{}/scene/status"
 MQTT_SCENE_COMMAND_TOPIC = "{}/{}/scene/set"
 MQTT_SCAN_LAMPS_COMMAND_TOPIC = "{}/scan"
+MQTT_SCAN_PROGRESS_TOPIC = "{}/scan/progress"
 MQTT_POLL_LAMPS_COMMAND_TOPIC = "{}/poll"
+MQTT_BUS_STATUS_TOPIC = "{}/bus/status"
+MQTT_PROBE_COMMAND_TOPIC = "{}/probe"
+MQTT_PROBE_TOPIC = "{}/bus/probe"
+MQTT_PROFILE_COMMAND_TOPIC = "{}/admin/profile"
+MQTT_PROFILE_RESULT_TOPIC = "{}/admin/profile/result"
+MQTT_RELOAD_COMMAND_TOPIC = "{}/admin/reload"
+MQTT_HISTORY_COMMAND_TOPIC = "{}/history/get"
+MQTT_HISTORY_RESULT_TOPIC = "{}/history/result"
+MQTT_BRIDGE_DEVICES_TOPIC = "{}/bridge/devices"
+MQTT_WARM_START_MARKER_TOPIC = "{}/bridge/warm_start"
+MQTT_BRIDGE_STATE_TOPIC = "{}/bridge/state"
+MQTT_BRIDGE_STATE_DELTA_TOPIC = "{}/bridge/state/delta"
 MQTT_PAYLOAD_ON = b"ON"
 MQTT_PAYLOAD_OFF = b"OFF"
 MQTT_AVAILABLE = "online"
 MQTT_NOT_AVAILABLE = "offline"
 
+SCAN_CHUNK_SIZE = 8
+# Seconds between checks for lamps which failed while scanned and may be read again
+SCAN_RETRY_CHECK = 5
+# Commands kept for the lights the first scan didn't read yet
+SCAN_DEFERRED_COMMANDS = 256
+SCAN_STATE_SCANNING = "scanning"
+SCAN_STATE_READING = "reading"
+SCAN_STATE_DONE = "done"
+SCAN_STATE_CANCELLED = "cancelled"
+SCAN_STATE_FAILED = "failed"
+
 HA_DISCOVERY_PREFIX_LIGHT = "{}/light/{}/{}/config"
 HA_DISCOVERY_PREFIX_SELECT = "{}/select/{}/{}/config"
 HA_DISCOVERY_PREFIX_BUTTON = "{}/button/{}/{}/config"
+# Template schema light, driving the brightness topic with JSON so Home Assistant can pass a transition
+HA_TRANSITION_TEMPLATE = "{% if transition is defined %}, \"transition\": {{ transition }}{% endif %}"
+HA_COMMAND_ON_TEMPLATE = "{\"brightness\": {{ brightness | d(255) }}" + HA_TRANSITION_TEMPLATE + "}"
+HA_COMMAND_OFF_TEMPLATE = "{\"brightness\": 0" + HA_TRANSITION_TEMPLATE + "}"
+HA_STATE_TEMPLATE = "{{ 'on' if value | int > 0 else 'off' }}"
+HA_BRIGHTNESS_TEMPLATE = "{{ value | int }}"
 
 BUTTONS = [
     {
         "name": "Poll lamps",
+        "slug": "poll-lamps",
         "command_topic": MQTT_POLL_LAMPS_COMMAND_TOPIC,
         "device_class": None,
         "entity_category": "config"
     },
     {
         "name": "Reinitialize lamps",
+        "slug": "reinitialize-lamps",
         "command_topic": MQTT_SCAN_LAMPS_COMMAND_TOPIC,
         "device_class": "restart",
         "entity_category": "config"
@@ -122,4 +343,12 @@ BUTTONS = [
 
 
 class SetupError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class DriverError(Exception):
+    pass
+
+
+class ConfigError(Exception):
+    pass
@@ -0,0 +1,168 @@
+"""Local control socket, for automation running on the same host as the bridge."""
+import json
+import os
+import socketserver
+import threading
+
+from dali.exceptions import DALIError
+
+from .config import Config
+from .consts import *
+from .dali2mqtt import get_light_object, run_command, set_lamp_levels
+from .lamp import Lamp
+from .transaction import transaction
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """One JSON request per line, answered by one JSON line.
+
+    {"op": "set", "device": "lamp_1", "brightness": 128, "transition": 2}
+    {"op": "scene", "device": "group_0", "scene": 3}
+    {"op": "query", "device": "lamp_1"}, or without device for all of them
+    {"op": "bulk", "commands": [{"op": "set", ...}, {"op": "scene", ...}]}
+
+    Answers are {"ok": true, ...} or {"ok": false, "error": "..."}, with the
+    "id" of the request when it had one.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                request, response = {}, {"ok": False, "error": "request must be a JSON object"}
+            else:
+                try:
+                    response = self.server.execute(request)
+                except (ControlError, DALIError, ValueError) as err:
+                    response = {"ok": False, "error": str(err)}
+            if "id" in request:
+                response["id"] = request["id"]
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serve the control socket, applying the commands like the MQTT ones, state included."""
+    daemon_threads = True
+
+    def __init__(self, data_object, path):
+        self.config = Config()
+        logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
+
+        self.data_object = data_object
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, ControlHandler)
+        os.chmod(path, CONTROL_SOCKET_MODE)
+
+    def start(self):
+        logger.info(f"Control socket on {self.server_address}")
+        threading.Thread(target=self.serve_forever, name="control-socket", daemon=True).start()
+
+    def execute(self, request):
+        shard = self.data_object.get("shard")
+        if shard is not None and not shard.owning:
+            raise ControlError("this shard doesn't own the DALI line")
+        if request.get("op") == "query":
+            with transaction():
+                return self._query(request.get("device"))
+        # Recorded and applied like the MQTT commands, one at a time with them
+        return run_command(self.data_object, CONTROL_HISTORY_SUBJECT, json.dumps(request), self._execute, request)
+
+    def _execute(self, request):
+        if request.get("op") == "bulk":
+            commands = request.get("commands")
+            if not isinstance(commands, list):
+                raise ControlError("bulk needs a list of commands")
+            results = [None] * len(commands)
+            # Lamp levels are set together, where scene calls can reproduce them
+            pending = {}
+            for index, command in enumerate(commands):
+                try:
+                    lamp_level = self._lamp_level(command)
+                    if lamp_level is not None:
+                        pending[index] = lamp_level
+                        continue
+                    self._set_levels(pending, results)
+                    results[index] = self._apply(command)
+                except (ControlError, DALIError, ValueError) as err:
+                    results[index] = {"ok": False, "error": str(err)}
+            self._set_levels(pending, results)
+            return {"ok": all(x["ok"] for x in results), "results": results}
+        return self._apply(request)
+
+    def _apply(self, command):
+        if not isinstance(command, dict):
+            raise ControlError("command must be an object")
+        light = self._light(command.get("device"))
+        op = command.get("op")
+        if op == "set":
+            level, transition = self._set_arguments(command)
+            light.setLevel(level, transition=transition)
+        elif op == "scene":
+            scene = command.get("scene")
+            if not isinstance(scene, int) or not 0 <= scene <= 15:
+                raise ControlError(f"invalid scene {scene}")
+            light.setScene(scene)
+        else:
+            raise ControlError(f"unknown op {op}")
+        return {"ok": True, **self._state(light)}
+
+    @staticmethod
+    def _set_arguments(command):
+        level = command.get("brightness")
+        transition = command.get("transition")
+        if not isinstance(level, int) or not 0 <= level <= 255:
+            raise ControlError(f"invalid brightness {level}")
+        if transition is not None and not (isinstance(transition, (int, float)) and transition >= 0):
+            raise ControlError(f"invalid transition {transition}")
+        return level, transition
+
+    def _lamp_level(self, command):
+        """The lamp and brightness of a set command on a lamp without transition, None for other commands."""
+        if not isinstance(command, dict) or command.get("op") != "set":
+            return None
+        light = self._light(command.get("device"))
+        level, transition = self._set_arguments(command)
+        if not isinstance(light, Lamp) or transition is not None:
+            return None
+        return light, level
+
+    def _set_levels(self, pending, results):
+        if not pending:
+            return
+        failed = set_lamp_levels(self.data_object, {lamp: level for lamp, level in pending.values()})
+        for index, (lamp, _) in pending.items():
+            if lamp in failed:
+                results[index] = {"ok": False, "error": str(failed[lamp])}
+            else:
+                results[index] = {"ok": True, **self._state(lamp)}
+        pending.clear()
+
+    def _query(self, device):
+        if device is not None:
+            return {"ok": True, **self._state(self._light(device))}
+        lights = list(self.data_object["all_lamps"].values()) + list(self.data_object["all_groups"].values())
+        return {"ok": True, "devices": [self._state(_x) for _x in lights]}
+
+    def _light(self, device):
+        light = get_light_object(self.data_object, device) if isinstance(device, str) else None
+        if light is None:
+            raise ControlError(f"unknown device {device}")
+        return light
+
+    @staticmethod
+    def _state(light):
+        return {"device": light.device_name, "brightness": light.level, "scene": light.current_scene}
@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 """Bridge between a DALI controller and an MQTT bus."""
 import json
-import traceback
+import sqlite3
+import threading
+import time
 
-import paho.mqtt.client as mqtt
-import dali.address as address
 import dali.gear.general as gear
-from dali.command import YesNoResponse
 from dali.exceptions import DALIError
-from slugify import slugify
 
+from .addresshealth import AddressHealth
+from .bus import Bus
 from .config import Config
-from .group import Group
-from .lamp import Lamp
 from .devicesnamesconfig import DevicesNamesConfig
+from .lamp import Lamp
+from .offline import OfflineBuffer
+from .poller import Poller
+from .prober import Prober
+from .profiler import Profiler
+from .scanner import Scanner
+from .scenes import LevelCoalescer, set_levels
+from .sharding import ShardCoordinator
+from .snapshot import Snapshot
+from .startup import StartupProfile
+from .transaction import StatePublisher, transaction
 
 from .consts import *
 
@@ -21,107 +30,6 @@ logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
 
-def scan_lamps(driver):
-    """Scan a maximum number of dali devices."""
-    lamps = []
-    config = Config()
-    for lamp in range(0, 64):
-        try:
-            logger.debug("Search for Lamp %s", lamp)
-            present = driver.send(gear.QueryControlGearPresent(address.Short(lamp)))
-            if isinstance(present, YesNoResponse) and present.value:
-                lamps.append(lamp)
-                logger.debug("Found lamp at address %d", lamp)
-                if len(lamps) >= config[CONF_DALI_LAMPS]:
-                    logger.warning("All %s configured lamps have been found, Stopping scan", config[CONF_DALI_LAMPS])
-                    logger.info("Found %d lamps", len(lamps))
-                    return lamps
-        except DALIError as err:
-            logger.warning("%s not present: %s", lamp, err)
-
-    logger.info("Found %d lamps", len(lamps))
-    return lamps
-
-
-def scan_groups(dali_driver, lamps):
-    logger.info("Scanning for groups:")
-    groups = {}
-    for lamp in lamps:
-        try:
-            logger.debug("Search for groups for Lamp {}".format(lamp))
-            group1 = dali_driver.send(gear.QueryGroupsZeroToSeven(address.Short(lamp))).value.as_integer
-            group2 = dali_driver.send(gear.QueryGroupsEightToFifteen(address.Short(lamp))).value.as_integer
-
-            lamp_groups = []
-
-            for i in range(8):
-                checkgroup = 1 << i
-                logger.debug("Check pattern: %d", checkgroup)
-                if (group1 & checkgroup) == checkgroup:
-                    if not i in groups:
-                        groups[i] = []
-                    groups[i].append(lamp)
-                    lamp_groups.append(i)
-                if (group2 & checkgroup) != 0:
-                    if not i + 8 in groups:
-                        groups[i + 8] = []
-                    groups[i + 8].append(lamp)
-                    lamp_groups.append(i + 8)
-
-            logger.debug("Lamp %d is in groups %s", lamp, lamp_groups)
-
-        except Exception as e:
-            logger.warning("Can't get groups for lamp %s: %s", lamp, e)
-    logger.info("Finished scanning for groups")
-    return groups
-
-
-def initialize_lamps(data_object, client):
-    logger.info("initializing lamps...")
-    driver_object = data_object["driver"]
-    lamps = scan_lamps(driver_object)
-    logger.info("Getting lamp parameters:")
-    for lamp in lamps:
-        try:
-            _address = address.Short(lamp)
-            lamp = Lamp(driver_object, client, _address)
-            data_object["all_lamps"][lamp.address] = lamp
-
-        except Exception as err:
-            logger.error("While initializing lamp<%s>: %s", lamp, err)
-            print(traceback.format_exc())
-            raise err
-
-    groups = scan_groups(driver_object, lamps)
-    for group, group_lamps in groups.items():
-        try:
-            _address = address.Group(group)
-            _lamps = []
-            for _x in group_lamps:
-                _lamps.append(data_object["all_lamps"][_x])
-            group = Group(driver_object, client, _address, _lamps)
-            for _x in group_lamps:
-                data_object["all_lamps"][_x].addGroup(group)
-            data_object["all_groups"][group.address] = group
-
-        except Exception as err:
-            logger.error("While initializing group<%s>: %s", group, err)
-            print(traceback.format_exc())
-            raise err
-
-    devices_names_config = DevicesNamesConfig()
-    if devices_names_config.is_devices_file_empty():
-        devices_names_config.save_devices_names_file(
-            list(data_object["all_lamps"].values()) + list(data_object["all_groups"].values()))
-
-    config = Config()
-    client.publish(
-        MQTT_DALI2MQTT_STATUS.format(config[CONF_MQTT_BASE_TOPIC]), MQTT_AVAILABLE, retain=True
-    )
-    logger.info("initializing lamps finished")
-
-
-
 def get_light_object(data_object, light):
     try:
         _x = light.split("_")
@@ -186,11 +94,28 @@ def on_message_brightness_cmd(mqtt_client, data_object, msg):
     if light is None:
         return
     level = msg.payload.decode("utf-8")
+    transition = None
+
+    # Either a plain brightness or {"brightness": 128, "transition": 2.5}
+    if level.startswith("{"):
+        try:
+            data = json.loads(level)
+            level = str(data["brightness"])
+            transition = data.get("transition")
+            if transition is not None and not (isinstance(transition, (int, float)) and transition >= 0):
+                raise ValueError(f"invalid transition {transition}")
+        except (ValueError, KeyError, TypeError) as err:
+            logger.error(f"Invalid payload for {light}: {level} ({err})")
+            return
 
     if level.isdigit() and 0 <= int(level) < 256:
         level = int(level)
+        if isinstance(light, Lamp) and transition is None:
+            data_object["coalescer"].add(light, level)
+            return
+        data_object["coalescer"].flush()
         try:
-            light.setLevel(level)
+            light.setLevel(level, transition=transition)
             logger.debug(f"Set {light.device_name} to {level}")
         except DALIError as err:
             logger.error(f"Failed to set {light.device_name} to OFF: {err}")
@@ -228,61 +153,234 @@ def on_message_reinitialize_lamps_cmd(mqtt_client, data_object, msg):
     """Callback on MQTT scan lamps command message"""
     logger.debug("Reinitialize Command on %s", msg.topic)
     logger.info("Reinitializing lamps")
-    config = Config()
-    mqtt_client.publish(
-        MQTT_DALI2MQTT_STATUS.format(config[CONF_MQTT_BASE_TOPIC]), MQTT_NOT_AVAILABLE, retain=True
+    data_object["scanner"].request()
+
+
+def poll_lamps(data_object, lamps=None):
+    """Read the actual level of the lamps, all by default, in one pipelined batch."""
+    if not data_object["bridging"].is_set():
+        return
+    health = AddressHealth()
+    # Lamps which keep failing are only polled once their backoff has passed
+    lamps = [
+        _x for _x in (list(data_object["all_lamps"].values()) if lamps is None else lamps)
+        if health.available(_x.address)
+    ]
+    responses = data_object["driver"].query_many(
+        [gear.QueryActualLevel(_x.dali_lamp) for _x in lamps], BUS_PRIORITY_POLL, return_exceptions=True
     )
-    initialize_lamps(data_object, mqtt_client)
+    with transaction():
+        for lamp, response in zip(lamps, responses):
+            if not health.check(lamp.address, response):
+                logger.warning(f"Failed to poll {lamp.device_name}: {response}")
+                continue
+            lamp.pollLevel(response.value)
+        for _x in list(data_object["all_groups"].values()):
+            _x.recalc_level()
 
 
 def on_message_poll_lamps_cmd(mqtt_client, data_object, msg):
     """Callback on MQTT poll lamps command message"""
     logger.debug("Poll lamps command on %s", msg.topic)
     logger.info("Polling lamps")
-    for _x in data_object["all_lamps"].values():
-        _x.pollLevel()
-    for _x in data_object["all_groups"].values():
-        _x.recalc_level()
+    poll_lamps(data_object)
     logger.info("Polling lamps finished")
 
 
+def on_message_probe_cmd(mqtt_client, data_object, msg):
+    """Callback on MQTT probe command message"""
+    logger.debug("Probe command on %s", msg.topic)
+    data_object["prober"].request()
+
+
+def reload_devices_names(data_object):
+    """Apply changed friendly names, without touching the bus."""
+    if not data_object["bridging"].is_set():
+        # The lights are read again, names included, once the line is bridged
+        return
+    renamed = [
+        _x for _x in list(data_object["all_lamps"].values()) + list(data_object["all_groups"].values())
+        if _x.updateFriendlyName()
+    ]
+    logger.info("Renamed %d lights", len(renamed))
+    if renamed:
+        data_object["snapshot"].publish_inventory()
+
+
+def on_message_profile_cmd(mqtt_client, data_object, msg):
+    """Callback on MQTT profile command message"""
+    logger.debug("Profile command on %s: %s", msg.topic, msg.payload)
+    try:
+        request = json.loads(msg.payload)
+        if not isinstance(request, dict):
+            raise ValueError("payload must be a JSON object")
+        Profiler().start(mqtt_client, request)
+    except ValueError as err:
+        logger.error(f"Invalid profile command {msg.payload}: {err}")
+
+
+def on_message_history_cmd(mqtt_client, data_object, msg):
+    """Callback on MQTT history query, the rows are published on the history result topic."""
+    logger.debug("History query on %s: %s", msg.topic, msg.payload)
+    try:
+        request = json.loads(msg.payload)
+        if not isinstance(request, dict):
+            raise ValueError("payload must be a JSON object")
+        result = {
+            "rows": data_object["history"].query(
+                kind=request.get("kind", "levels"),
+                subject=request.get("subject"),
+                since=request.get("since"),
+                until=request.get("until"),
+                limit=int(request.get("limit", HISTORY_QUERY_LIMIT)),
+            )
+        }
+    except (TypeError, ValueError) as err:
+        logger.error(f"Invalid history query {msg.payload}: {err}")
+        result = {"error": str(err)}
+    except sqlite3.Error as err:
+        logger.error(f"History query {msg.payload} failed: {err}")
+        result = {"error": str(err)}
+    mqtt_client.publish(MQTT_HISTORY_RESULT_TOPIC.format(Config()[CONF_MQTT_BASE_TOPIC]), json.dumps(result))
+
+
+def on_message_reload_cmd(mqtt_client, data_object, msg):  # pylint: disable=W0613
+    """Callback on MQTT reload command message"""
+    data_object["reload"]()
+
+
+def run_command(data_object, subject, detail, function, *args, coalescing=False):
+    """Record a command in the history and apply it as one transaction, publishing each state topic it changed once.
+
+    The brightness targets still gathered are set first, unless the command is coalescing and may add to them.
+    """
+    if "history" in data_object:
+        data_object["history"].record_event("command", subject, detail)
+    with transaction():
+        if not coalescing:
+            data_object["coalescer"].flush()
+        return Profiler().run(function, *args)
+
+
+def set_lamp_levels(data_object, targets):
+    """Set lamps to their brightness with set_levels(), returning the lamps which failed."""
+    # Scene calls on groups or the whole bus could change gear missing from the inventory
+    if data_object["scanner"].complete:
+        lamps, groups = list(data_object["all_lamps"].values()), list(data_object["all_groups"].values())
+    else:
+        lamps, groups = [], []
+    return set_levels(data_object["driver"], targets, lamps, groups)
+
+
+def handle_command(callback, coalescing=False):
+    """Apply the commands received on MQTT with run_command, once the first scan read their light."""
+
+    def apply(mqtt_client, data_object, msg):
+        light = msg.topic.split("/")[1]
+        if not data_object["scanner"].defer(light, lambda: callback(mqtt_client, data_object, msg)):
+            callback(mqtt_client, data_object, msg)
+
+    def wrapper(mqtt_client, data_object, msg):
+        if not data_object["bridging"].is_set():
+            # Left from a session of the broker when this shard owned the line
+            logger.warning(f"Not bridging the DALI line, ignoring {msg.topic}")
+            return
+        run_command(
+            data_object, msg.topic, msg.payload.decode("utf-8", "replace"), apply, mqtt_client, data_object, msg,
+            coalescing=coalescing,
+        )
+
+    return wrapper
+
+
 def on_message(mqtt_client, data_object, msg):  # pylint: disable=W0613
     """Default callback on MQTT message."""
     logger.error("Don't publish to %s", msg.topic)
 
 
-def on_connect(client, data_object, flags, result):  # pylint: disable=W0613,R0913
-    """Callback on connection to MQTT server."""
+def command_topics():
     config = Config()
-    client.subscribe(
-        [
-            (MQTT_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"), 0),
-            (MQTT_FLASH_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"), 0),
-            (MQTT_BRIGHTNESS_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"), 0),
-            (MQTT_SCENE_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"), 0),
-            (MQTT_SCAN_LAMPS_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]), 0),
-            (MQTT_POLL_LAMPS_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]), 0),
-        ]
-    )
+    return [
+        MQTT_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"),
+        MQTT_FLASH_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"),
+        MQTT_BRIGHTNESS_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"),
+        MQTT_SCENE_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"),
+        MQTT_SCAN_LAMPS_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]),
+        MQTT_POLL_LAMPS_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]),
+        MQTT_PROBE_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]),
+    ]
+
+
+def on_connect(client, data_object, flags, result, properties=None):  # pylint: disable=W0613,R0913
+    """Callback on connection to MQTT server, properties are only given with MQTT v5."""
+    StartupProfile().end("mqtt connect")
+    if properties is not None:
+        client.connected(properties)
+    data_object["buffer"].connected()
+    publish_bus_health(client, data_object["driver"].status())
+    if Config()[CONF_ADMIN_PROFILING]:
+        client.subscribe(MQTT_PROFILE_COMMAND_TOPIC.format(Config()[CONF_MQTT_BASE_TOPIC]))
+    client.subscribe(MQTT_RELOAD_COMMAND_TOPIC.format(Config()[CONF_MQTT_BASE_TOPIC]))
+    if "history" in data_object:
+        client.subscribe(MQTT_HISTORY_COMMAND_TOPIC.format(Config()[CONF_MQTT_BASE_TOPIC]))
+    if "shard" in data_object:
+        # Only the shard owning the line bridges it
+        data_object["bridging"].clear()
+        data_object["shard"].start()
+    else:
+        start_bridge(client, data_object)
+
+
+def on_disconnect(client, data_object, result, properties=None):  # pylint: disable=W0613
+    """Callback on disconnection from MQTT server, buffering what is published until connected again."""
+    if result:
+        logger.warning(f"Disconnected from the MQTT server ({result})")
+    data_object["buffer"].disconnected()
+    if "shard" in data_object:
+        # Another shard may take the line over while this one can't see the claims
+        data_object["shard"].stop()
+        data_object["bridging"].clear()
+        data_object["scanner"].cancel()
+
+
+def start_bridge(client, data_object):
+    """Serve the commands and (re)scan the bus."""
+    logger.info("Bridging the DALI line")
+    data_object["bridging"].set()
+    client.subscribe([(topic, 0) for topic in command_topics()])
+    # Lamps known from a previous connection stay controllable while they are rescanned
     client.publish(
-        MQTT_DALI2MQTT_STATUS.format(config[CONF_MQTT_BASE_TOPIC]), MQTT_NOT_AVAILABLE, retain=True
+        Config().availability_topic,
+        MQTT_AVAILABLE if data_object["all_lamps"] or "shard" in data_object else MQTT_NOT_AVAILABLE,
+        retain=True,
     )
-    initialize_lamps(data_object, client)
+    if Config()[CONF_WARM_START] and not data_object["all_lamps"]:
+        data_object["scanner"].collect_retained_state()
+    data_object["scanner"].request()
     register_bridge(client)
 
 
+def stop_bridge(client, data_object):
+    """Leave the line to another shard."""
+    logger.warning("Another shard took the DALI line over, standing by")
+    data_object["bridging"].clear()
+    client.unsubscribe(command_topics())
+    data_object["scanner"].cancel()
+
+
 def register_bridge(client):
     logger.info("registering buttons")
+    started = time.monotonic()
     config = Config()
     for button in BUTTONS:
         json_config = {
             "name": button['name'],
-            "unique_id": "{}_BUTTON_{}".format(config[CONF_MQTT_BASE_TOPIC], slugify(button['name'])),
+            "unique_id": "{}_BUTTON_{}".format(config[CONF_MQTT_BASE_TOPIC], button['slug']),
             "command_topic": button['command_topic'].format(
                 config[CONF_MQTT_BASE_TOPIC]
             ),
             "entity_category": button['entity_category'],
-            "availability_topic": MQTT_DALI2MQTT_STATUS.format(config[CONF_MQTT_BASE_TOPIC]),
+            "availability_topic": config.availability_topic,
             "payload_available": MQTT_AVAILABLE,
             "payload_not_available": MQTT_NOT_AVAILABLE,
             "device": {
@@ -299,100 +397,127 @@ def register_bridge(client):
         logger.debug(f"Register button {button['name']}")
         client.publish(
             HA_DISCOVERY_PREFIX_BUTTON.format(config[CONF_HA_DISCOVERY_PREFIX], config[CONF_MQTT_BASE_TOPIC],
-                                              slugify(button['name'])),
+                                              button['slug']),
             json.dumps(json_config),
             retain=True,
         )
+    StartupProfile().record("discovery", started)
+
 
+def create_mqtt_client(data_object, mqttc=None):
+    """Create MQTT client object, setup callbacks and connection to server.
 
-def create_mqtt_client(driver_object):
-    """Create MQTT client object, setup callbacks and connection to server."""
+    mqttc replaces the paho client, e.g. with a LoopbackClient.
+    """
 
     config = Config()
     logger.debug("Connecting to %s:%s", config[CONF_MQTT_SERVER], config[CONF_MQTT_PORT])
-    mqttc = mqtt.Client(
-        client_id="dali2mqttx",
-        userdata={
-            "driver": driver_object,
-            "all_lamps": {},
-            "all_groups": {}
-        },
-    )
-    mqttc.will_set(
-        MQTT_DALI2MQTT_STATUS.format(config[CONF_MQTT_BASE_TOPIC]), MQTT_NOT_AVAILABLE, retain=True
-    )
+    client_id = MQTT_SHARD_CLIENT_ID.format(config[CONF_SHARD_ID]) if config[CONF_SHARD_ID] else MQTT_CLIENT_ID
+    if config[CONF_MQTT_PROTOCOL] == MQTT_PROTOCOL_V5:
+        from .mqtt5 import AliasingClient, command_callback
+
+        if mqttc is None:
+            mqttc = AliasingClient(client_id)
+    else:
+        def command_callback(callback):
+            return callback
+
+        if mqttc is None:
+            import paho.mqtt.client as mqtt
+
+            mqttc = mqtt.Client(client_id=client_id)
+    mqttc.user_data_set(data_object)
+    data_object["buffer"] = OfflineBuffer(mqttc, config[CONF_OFFLINE_BUFFER_SIZE])
+    publisher = StatePublisher(data_object["buffer"])
+    data_object["snapshot"] = Snapshot(data_object, data_object["buffer"])
+    publisher.listeners.append(lambda topic, payload: data_object["snapshot"].changed())
+    if "history" in data_object:
+        publisher.listeners.append(data_object["history"].listener(config[CONF_MQTT_BASE_TOPIC]))
+        mqttc.message_callback_add(
+            MQTT_HISTORY_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]), on_message_history_cmd
+        )
+    data_object["scanner"] = Scanner(data_object, publisher)
+    if config[CONF_SHARD_ID]:
+        data_object["shard"] = ShardCoordinator(
+            mqttc, lambda: start_bridge(mqttc, data_object), lambda: stop_bridge(mqttc, data_object)
+        )
+    mqttc.will_set(config.availability_topic, MQTT_NOT_AVAILABLE, retain=True)
     mqttc.on_connect = on_connect
+    mqttc.on_disconnect = on_disconnect
 
     # Add message callbacks that will only trigger on a specific subscription match.
     mqttc.message_callback_add(
-        MQTT_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"), on_message_cmd
+        MQTT_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"),
+        command_callback(handle_command(on_message_cmd)),
     )
     mqttc.message_callback_add(
-        MQTT_FLASH_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"), on_message_flash
+        MQTT_FLASH_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"),
+        command_callback(handle_command(on_message_flash)),
     )
     mqttc.message_callback_add(
         MQTT_BRIGHTNESS_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"),
-        on_message_brightness_cmd,
+        command_callback(handle_command(on_message_brightness_cmd, coalescing=True)),
     )
     mqttc.message_callback_add(
         MQTT_SCENE_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC], "+"),
-        on_message_scene_cmd,
+        command_callback(handle_command(on_message_scene_cmd)),
     )
     mqttc.message_callback_add(
         MQTT_SCAN_LAMPS_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]),
-        on_message_reinitialize_lamps_cmd,
+        command_callback(handle_command(on_message_reinitialize_lamps_cmd)),
     )
     mqttc.message_callback_add(
         MQTT_POLL_LAMPS_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]),
-        on_message_poll_lamps_cmd,
+        command_callback(handle_command(on_message_poll_lamps_cmd)),
+    )
+    mqttc.message_callback_add(
+        MQTT_PROBE_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]),
+        command_callback(on_message_probe_cmd),
     )
 
+    if config[CONF_ADMIN_PROFILING]:
+        mqttc.message_callback_add(
+            MQTT_PROFILE_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]), on_message_profile_cmd
+        )
+
+    mqttc.message_callback_add(MQTT_RELOAD_COMMAND_TOPIC.format(config[CONF_MQTT_BASE_TOPIC]), on_message_reload_cmd)
+
     mqttc.on_message = on_message
 
     if config[CONF_MQTT_USERNAME] != '':
         mqttc.username_pw_set(config[CONF_MQTT_USERNAME], config[CONF_MQTT_PASSWORD])
 
+    StartupProfile().begin("mqtt connect")
     mqttc.connect(config[CONF_MQTT_SERVER], config[CONF_MQTT_PORT], 180)
     return mqttc
 
 
-def main(args):
-    config = Config()
-    config.setup(args)
-
-    if config[CONF_LOG_COLOR]:
-        logging.addLevelName(
-            logging.WARNING,
-            "{}{}".format(YELLOW_COLOR, logging.getLevelName(logging.WARNING)),
-        )
-        logging.addLevelName(
-            logging.ERROR, "{}{}".format(RED_COLOR, logging.getLevelName(logging.ERROR))
-        )
-
-    logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[config[CONF_LOG_LEVEL]])
-    devices_names_config = DevicesNamesConfig()
-    devices_names_config.setup()
+def open_driver():
+    """Open the configured DALI driver, only importing the modules it needs.
 
+    Raises DriverError when the adapter can't be used.
+    """
+    config = Config()
     dali_driver = None
     logger.debug("Using <%s> driver", config[CONF_DALI_DRIVER])
 
     if config[CONF_DALI_DRIVER] == HASSEB:
-        from dali.driver.hasseb import SyncHassebDALIUSBDriver
+        # Batches are only pipelined with a dali_pipeline_depth above 1, the frames are paced anyway
+        from .hasseb import PipelinedSyncHassebDALIUSBDriver as SyncHassebDALIUSBDriver
 
         dali_driver = SyncHassebDALIUSBDriver()
 
         try:
             firmware_version = float(dali_driver.readFirmwareVersion())
-        except AttributeError:
-            logger.error("Could not open device. Is the hasseb adapter connected and has the right permissions?")
-            quit(1)
-            return
+        except (AttributeError, OSError, ValueError) as err:
+            raise DriverError(
+                "Could not open device. Is the hasseb adapter connected and has the right permissions?"
+            ) from err
         if firmware_version < MIN_HASSEB_FIRMWARE_VERSION:
-            logger.error("Using dali2mqtt requires newest hasseb firmware")
-            logger.error(
-                "Please, look at https://github.com/hasseb/python-dali/tree/master/dali/driver/hasseb_firmware"
+            raise DriverError(
+                "Using dali2mqtt requires newest hasseb firmware, please look at "
+                "https://github.com/hasseb/python-dali/tree/master/dali/driver/hasseb_firmware"
             )
-            quit(1)
         # Force disable sniffing, as we get strange return values when sniffing is enabled
         dali_driver.disableSniffing()
     elif config[CONF_DALI_DRIVER] == TRIDONIC:
@@ -400,11 +525,168 @@ def main(args):
 
         dali_driver = SyncTridonicDALIUSBDriver()
     elif config[CONF_DALI_DRIVER] == DALI_SERVER:
-        from dali.driver.daliserver import DaliServer
+        from .daliserver import PersistentDaliServer
+
+        dali_driver = PersistentDaliServer(
+            config[CONF_DALI_SERVER_HOST], config[CONF_DALI_SERVER_PORT], config[CONF_DALI_TRANSACTION_TIMEOUT]
+        )
+        try:
+            dali_driver.connect()
+        except OSError as err:
+            raise DriverError(
+                f"Could not connect to daliserver at {config[CONF_DALI_SERVER_HOST]}:{config[CONF_DALI_SERVER_PORT]}"
+            ) from err
+    elif config[CONF_DALI_DRIVER] == DUMMY:
+        from .simulator import SimulatedDALIDriver
+
+        dali_driver = SimulatedDALIDriver(config[CONF_DALI_LAMPS])
+    return dali_driver
+
+
+def publish_bus_health(client, health):
+    client.publish(
+        MQTT_BUS_STATUS_TOPIC.format(Config()[CONF_MQTT_BASE_TOPIC]), json.dumps(health), retain=True
+    )
+
+
+def on_bus_health(client, data_object, health):
+    publish_bus_health(client, health)
+    if "history" in data_object:
+        data_object["history"].record_event("bus", health["state"], health["last_error"])
+
+
+def replay_levels(data_object):
+    """Send the known levels again after the driver was reopened, the gear may have missed commands meanwhile."""
+    logger.info("Replaying lamp levels")
+    for lamp in list(data_object["all_lamps"].values()):
+        try:
+            lamp.restoreLevel()
+        except DALIError as err:
+            logger.warning(f"Failed to restore {lamp.device_name}: {err}")
+
+
+def set_log_level(level):
+    """Set the log level of every logger of the bridge."""
+    package = __name__.rpartition(".")[0]
+    for name, _x in list(logging.Logger.manager.loggerDict.items()):
+        if name.startswith(f"{package}.") and isinstance(_x, logging.Logger):
+            _x.setLevel(ALL_SUPPORTED_LOG_LEVELS[level])
 
-        dali_driver = DaliServer("localhost", 55825)
 
-    mqttc = create_mqtt_client(dali_driver)
+def reload_config(data_object, load_config):
+    """Load the configuration again and apply what changed, without rescanning the bus nor reconnecting."""
+    logger.info("Reloading the configuration")
+    try:
+        changed = Config().reload(load_config())
+    except (ConfigError, vol.Invalid) as err:
+        logger.error(f"Invalid configuration, keeping the running one: {err}")
+        return
+    if not changed:
+        logger.info("Configuration unchanged")
+        return
+    logger.info(f"Configuration changed: {', '.join(f'{key}={value}' for key, value in changed.items())}")
+
+    bus = data_object["driver"]
+    if CONF_LOG_LEVEL in changed:
+        set_log_level(changed[CONF_LOG_LEVEL])
+    if CONF_BUS_BACKGROUND_SHARE in changed:
+        bus.scheduler.background_share = changed[CONF_BUS_BACKGROUND_SHARE]
+    if CONF_DALI_TRANSACTION_TIMEOUT in changed:
+        bus.timing.max_timeout = changed[CONF_DALI_TRANSACTION_TIMEOUT]
+        bus.timing.timeout = min(bus.timing.timeout, bus.timing.max_timeout)
+    if CONF_POLL_INTERVAL in changed:
+        if "poller" in data_object:
+            data_object["poller"].reschedule(changed[CONF_POLL_INTERVAL])
+        else:
+            data_object["poller"] = Poller(lambda lamps: poll_lamps(data_object, lamps), changed[CONF_POLL_INTERVAL])
+    if CONF_OFFLINE_BUFFER_SIZE in changed:
+        data_object["buffer"].max_size = changed[CONF_OFFLINE_BUFFER_SIZE] * 1024
+    if CONF_PROBE_INTERVAL in changed:
+        data_object["prober"].reschedule(changed[CONF_PROBE_INTERVAL])
+    if CONF_HISTORY_MAX_SIZE in changed and "history" in data_object:
+        data_object["history"].max_size = changed[CONF_HISTORY_MAX_SIZE] * 1024 * 1024
+    if CONF_GROUP_MODE in changed:
+        with transaction():
+            for group in list(data_object["all_groups"].values()):
+                group.recalc_level()
+
+
+def main(args, mqttc=None, dali_driver=None, load_config=None):
+    """Run the bridge, mqttc and dali_driver replace the configured ones when given.
+
+    load_config() returns the configuration to apply when it is reloaded,
+    on SIGHUP or on the reload topic, args by default.
+    """
+    profile = StartupProfile()
+    started = time.monotonic()
+    config = Config()
+    config.setup(args)
+    profile.enabled = config[CONF_PROFILE_STARTUP]
+
+    if config[CONF_LOG_COLOR]:
+        logging.addLevelName(
+            logging.WARNING,
+            "{}{}".format(YELLOW_COLOR, logging.getLevelName(logging.WARNING)),
+        )
+        logging.addLevelName(
+            logging.ERROR, "{}{}".format(RED_COLOR, logging.getLevelName(logging.ERROR))
+        )
+
+    logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[config[CONF_LOG_LEVEL]])
+    devices_names_config = DevicesNamesConfig()
+    devices_names_config.setup()
+    profile.record("setup", started)
+
+    started = time.monotonic()
+    reopen = None
+    if dali_driver is None:
+        try:
+            dali_driver = open_driver()
+        except DriverError as err:
+            logger.error(err)
+            quit(1)
+            return
+        reopen = open_driver
+    profile.record("driver open", started)
+
+    bus = Bus(dali_driver, reopen)
+    data_object = {
+        "driver": bus,
+        "all_lamps": {},
+        "all_groups": {},
+        "reload": lambda: reload_config(data_object, load_config or (lambda: args)),
+        # Set while this process bridges the line, the background work stops meanwhile
+        "bridging": threading.Event(),
+    }
+    data_object["coalescer"] = LevelCoalescer(lambda targets: set_lamp_levels(data_object, targets))
+    if config[CONF_HISTORY_DB]:
+        from .history import History
+
+        data_object["history"] = History(config[CONF_HISTORY_DB], config[CONF_HISTORY_MAX_SIZE])
+    if config[CONF_POLL_INTERVAL] > 0 or config[CONF_WARM_START]:
+        data_object["poller"] = Poller(lambda lamps: poll_lamps(data_object, lamps), config[CONF_POLL_INTERVAL])
+    mqttc = create_mqtt_client(data_object, mqttc)
+    bus.on_health = lambda health: on_bus_health(data_object["buffer"], data_object, health)
+    bus.on_timing = lambda status: publish_bus_health(data_object["buffer"], status)
+    bus.on_recovered = lambda: replay_levels(data_object)
+    data_object["prober"] = Prober(
+        data_object, data_object["buffer"], lambda lamps: poll_lamps(data_object, lamps), config[CONF_PROBE_INTERVAL]
+    )
+    if threading.current_thread() is threading.main_thread():
+        import signal
+
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: threading.Thread(target=data_object["reload"], name="reload", daemon=True).start(),
+        )
+    if config[CONF_CONTROL_SOCKET]:
+        from .control import ControlServer
+
+        ControlServer(data_object, config[CONF_CONTROL_SOCKET]).start()
+    if config[CONF_DEVICES_NAMES_RELOAD_INTERVAL] > 0:
+        devices_names_config.watch(
+            lambda: reload_devices_names(data_object), config[CONF_DEVICES_NAMES_RELOAD_INTERVAL]
+        )
     try:
         mqttc.loop_forever()
     except KeyboardInterrupt:
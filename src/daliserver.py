@@ -0,0 +1,114 @@
+"""daliserver driver keeping its connection open between frames."""
+import select
+import socket
+import struct
+import threading
+
+from dali.driver.daliserver import DaliServer
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class PersistentDaliServer(DaliServer):
+    """Talk to daliserver over a single long lived connection.
+
+    The connection uses TCP keepalive, and is opened again when it was
+    dropped. The frames are only sent again when writing them failed on a
+    connection which had been idle, never once they may have reached the
+    bus. send_many() writes all its requests before reading the
+    responses, which daliserver sends back in the same order.
+    """
+
+    def __init__(self, host, port, timeout):
+        super().__init__(host, port, multiple_frames_per_connection=True)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self.close()
+        self._s = socket.create_connection(self._target, self.timeout)
+        self._s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (
+            ("TCP_KEEPIDLE", DALI_SERVER_KEEPALIVE_IDLE),
+            ("TCP_KEEPINTVL", DALI_SERVER_KEEPALIVE_INTERVAL),
+            ("TCP_KEEPCNT", DALI_SERVER_KEEPALIVE_COUNT),
+        ):
+            if hasattr(socket, option):
+                self._s.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        logger.debug("Connected to daliserver at %s:%s", *self._target)
+
+    def close(self):
+        if self._s is not None:
+            self._s.close()
+            self._s = None
+
+    def send(self, command):
+        return self.send_many([command])[0]
+
+    def send_many(self, commands):
+        messages = []
+        for command in commands:
+            message = struct.pack("BB", 2, 0) + command.frame.pack
+            messages.extend([message, message] if command.sendtwice else [message])
+
+        with self._lock:
+            reused = self._s is not None and not self._closed_by_server()
+            if not reused:
+                self.connect()
+            try:
+                self._send(messages)
+            except ConnectionError as err:
+                if not reused:
+                    raise
+                # The connection died while idle, daliserver didn't get the frames and they are worth a second try
+                logger.debug(f"daliserver connection failed ({err}), reconnecting")
+                self.connect()
+                self._send(messages)
+            # Once sent the frames may have been applied, a failure from here on is not retried
+            results = self._receive(len(messages))
+
+        responses = []
+        for command in reversed(commands):
+            # A command sent twice answers with its second frame
+            result = results.pop()
+            if command.sendtwice:
+                results.pop()
+            responses.append(self.unpack_response(command, result))
+        return responses[::-1]
+
+    def _closed_by_server(self):
+        """Whether daliserver closed the idle connection, which shows as the end of the stream."""
+        # A socket with a timeout would wait for it before peeking, select() tells at once whether there is anything
+        readable, _, _ = select.select([self._s], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self._s.recv(1, socket.MSG_PEEK) == b""
+        except BlockingIOError:
+            return False
+        except ConnectionError:
+            return True
+
+    def _send(self, messages):
+        try:
+            self._s.sendall(b"".join(messages))
+        except OSError:
+            self.close()
+            raise
+
+    def _receive(self, count):
+        try:
+            data = b""
+            while len(data) < 4 * count:
+                chunk = self._s.recv(4 * count - len(data))
+                if not chunk:
+                    raise EOFError("daliserver closed the connection")
+                data += chunk
+        except (OSError, EOFError):
+            self.close()
+            raise
+        return [data[x:x + 4] for x in range(0, len(data), 4)]
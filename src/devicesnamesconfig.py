@@ -1,7 +1,9 @@
 """Configuration Object."""
+import os
+import threading
+import time
 import traceback
 
-import yaml
 import logging
 
 from .config import Config
@@ -19,6 +21,7 @@ class DevicesNamesConfig:
     _done_setup = False
 
     _devices_names = {}
+    _mtime = None
 
     def __new__(cls):
         if cls._instance is None:
@@ -35,6 +38,7 @@ class DevicesNamesConfig:
 
         # Load from file
         try:
+            self._mtime = self._stat()
             self.load_devices_names_file()
         except FileNotFoundError:
             logger.info("No device names config, creating new one")
@@ -49,6 +53,8 @@ class DevicesNamesConfig:
     def load_devices_names_file(self):
         """Load configuration from yaml file."""
         self._did_setup()
+        import yaml
+
         try:
             with open(self._path, "r") as infile:
                 logger.debug("Loading devices names from <%s>", self._path)
@@ -59,6 +65,41 @@ class DevicesNamesConfig:
         except Exception as err:
             logger.warning("Could not load device names config: %s", err)
 
+    def _stat(self):
+        return os.stat(self._path).st_mtime_ns
+
+    def reload_if_changed(self):
+        """Reload the file if it was modified, return whether any name changed."""
+        self._did_setup()
+        try:
+            mtime = self._stat()
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        old_devices_names = self._devices_names
+        self.load_devices_names_file()
+        return self._devices_names != old_devices_names
+
+    def watch(self, on_change, interval):
+        """Check the file every interval seconds, and call on_change() when names changed."""
+        self._did_setup()
+
+        def _watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.reload_if_changed():
+                        logger.info("Devices names file changed, updating names")
+                        on_change()
+                except DevicesNamesConfigLoadError:
+                    logger.warning("Keeping the previous devices names")
+                except Exception as err:
+                    logger.error("While reloading devices names: %s", err)
+
+        threading.Thread(target=_watch, name="devices-names-watch", daemon=True).start()
+
     def save_devices_names_file(self, all_lamps):
         self._did_setup()
         self._devices_names = {}
@@ -68,6 +109,8 @@ class DevicesNamesConfig:
                     "friendly_name": str(lamp_object.friendly_name)
                 }
 
+            import yaml
+
             with open(self._path, "w") as outfile:
                 yaml.dump(
                     self._devices_names,
@@ -75,6 +118,7 @@ class DevicesNamesConfig:
                     default_flow_style=False,
                     allow_unicode=True,
                 )
+            self._mtime = self._stat()
         except Exception as err:
             logger.error("Could not save device names config: %s", err)
             print(traceback.format_exc())
@@ -83,10 +127,15 @@ class DevicesNamesConfig:
         self._did_setup()
         return len(self._devices_names) == 0
 
-    def get_friendly_name(self, short_address_value):
+    def get_friendly_name(self, device_name, default):
+        """Name given to device_name (lamp_N or group_N), or to the bare short address of a lamp, else default."""
         self._did_setup()
-        try:
-            friendly_name = f"Group {self._devices_names[short_address_value]['friendly_name']}"
-        except KeyError:
-            friendly_name = short_address_value
-        return friendly_name
+        keys = [device_name]
+        if device_name.startswith("lamp_"):
+            keys += [int(device_name[5:]), device_name[5:]]
+        for key in keys:
+            try:
+                return str(self._devices_names[key]["friendly_name"])
+            except (KeyError, TypeError):
+                pass
+        return default
@@ -11,6 +11,8 @@ from .consts import *
 
 from .devicesnamesconfig import DevicesNamesConfig
 from .functions import normalize
+from .transaction import unlocked
+from .transition import FADE_TIMES, RampPublisher, fade_time_for
 
 logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
@@ -27,8 +29,8 @@ class Group:
         self.address = dali_group.group
         self.lamps = lamps
 
-        self.friendly_name = DevicesNamesConfig().get_friendly_name(f"DALI Group {self.address}")
         self.device_name = f"group_{self.address}"
+        self.friendly_name = DevicesNamesConfig().get_friendly_name(self.device_name, f"DALI Group {self.address}")
 
         self.level = None
         self.recalc_level()
@@ -59,6 +61,17 @@ class Group:
     def __repr__(self):
         return f"GROUP {self.address}"
 
+    def addLamp(self, lamp):
+        """Add a lamp found after the group was created."""
+        self.lamps.append(lamp)
+        self.min_levels = min(self.min_levels, lamp.min_levels)
+        self.max_level = max(self.max_level, lamp.max_level)
+        scenes = len(self.scenes)
+        self.scenes.update([y for y in range(len(lamp.scenes)) if lamp.scenes[y] != "MASK"])
+        if len(self.scenes) != scenes:
+            self._register_discovery()
+        self.recalc_level()
+
     __str__ = __repr__
 
     def recalc_level(self):
@@ -74,6 +87,7 @@ class Group:
         else:
             raise RuntimeError(f"Invalid group mode: {self.config[CONF_GROUP_MODE]}")
         if old != self.level:
+            RampPublisher().cancel(self.device_name)
             self.mqtt.publish(
                 MQTT_BRIGHTNESS_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
                 self.level,
@@ -86,25 +100,31 @@ class Group:
                     retain=True,
                 )
 
+    def updateFriendlyName(self):
+        """Pick up a changed friendly name, republishing the discovery only when it changed."""
+        friendly_name = DevicesNamesConfig().get_friendly_name(self.device_name, f"DALI Group {self.address}")
+        if friendly_name == self.friendly_name:
+            return False
+        logger.info(f"Rename {self.friendly_name} to {friendly_name}")
+        self.friendly_name = friendly_name
+        self._register_discovery()
+        return True
+
     def _register_discovery(self):
         """Generate a automatic configuration for Home Assistant."""
         json_config = {
             "name": self.friendly_name,
             "unique_id": f"{self.config[CONF_MQTT_BASE_TOPIC]}_{self.device_name}",
-            "state_topic": MQTT_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
-            "command_topic": MQTT_COMMAND_TOPIC.format(
-                self.config[CONF_MQTT_BASE_TOPIC], self.device_name
-            ),
-            "payload_off": MQTT_PAYLOAD_OFF.decode("utf-8"),
-            "brightness_state_topic": MQTT_BRIGHTNESS_STATE_TOPIC.format(
+            "schema": "template",
+            "state_topic": MQTT_BRIGHTNESS_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
+            "command_topic": MQTT_BRIGHTNESS_COMMAND_TOPIC.format(
                 self.config[CONF_MQTT_BASE_TOPIC], self.device_name
             ),
-            "brightness_command_topic": MQTT_BRIGHTNESS_COMMAND_TOPIC.format(
-                self.config[CONF_MQTT_BASE_TOPIC], self.device_name
-            ),
-            "brightness_scale": 255,
-            "on_command_type": "brightness",
-            "availability_topic": MQTT_DALI2MQTT_STATUS.format(self.config[CONF_MQTT_BASE_TOPIC]),
+            "command_on_template": HA_COMMAND_ON_TEMPLATE,
+            "command_off_template": HA_COMMAND_OFF_TEMPLATE,
+            "state_template": HA_STATE_TEMPLATE,
+            "brightness_template": HA_BRIGHTNESS_TEMPLATE,
+            "availability_topic": self.config.availability_topic,
             "payload_available": MQTT_AVAILABLE,
             "payload_not_available": MQTT_NOT_AVAILABLE,
             "device": {
@@ -131,7 +151,7 @@ class Group:
                 self.config[CONF_MQTT_BASE_TOPIC], self.device_name
             ),
             "options": [],
-            "availability_topic": MQTT_DALI2MQTT_STATUS.format(self.config[CONF_MQTT_BASE_TOPIC]),
+            "availability_topic": self.config.availability_topic,
             "payload_available": MQTT_AVAILABLE,
             "payload_not_available": MQTT_NOT_AVAILABLE,
             "device": {
@@ -154,22 +174,46 @@ class Group:
             retain=True,
         )
 
-    def setLevel(self, level):
+    def setLevel(self, level, transition=None):
         old = self.level
         self.level = level
-        self._sendLevelDALI(level)
+        self._sendLevelDALI(level, transition)
 
         affected_groups = set()
         for lamp in self.lamps:
-            lamp.setLevel(level, False)
+            lamp.setLevel(level, False, transition)
             affected_groups.update(lamp.groups)
 
         for _x in affected_groups:
             _x.recalc_level()
 
-        self._sendLevelMQTT(level, old)
+        if transition:
+            self._rampLevelMQTT(level, old, FADE_TIMES[fade_time_for(transition)])
+        else:
+            RampPublisher().cancel(self.device_name)
+            self._sendLevelMQTT(level, old)
+
+    def setFadeTime(self, transition):
+        """Program the fade time of the members, only on the gear which doesn't already have it."""
+        if transition is None:
+            # Back to the fade time each member had before any transition, with one group frame when they share it
+            defaults = {x.default_fade_time for x in self.lamps}
+            if len(defaults) != 1:
+                for lamp in self.lamps:
+                    lamp.setFadeTime(lamp.default_fade_time)
+                return
+            fade_time = defaults.pop()
+        else:
+            fade_time = fade_time_for(transition)
+        if all(x.fade_time == fade_time for x in self.lamps):
+            return
+        self.driver.send_sequence([gear.DTR0(fade_time), gear.SetFadeTime(self.dali_group)])
+        for lamp in self.lamps:
+            lamp.fade_time = fade_time
+        logger.debug(f"Set {self.friendly_name} fade time to {FADE_TIMES[fade_time]:.1f}s ({fade_time})")
 
     def setScene(self, scene):
+        RampPublisher().cancel(self.device_name)
         self.setSceneToNoneMQTT()
         if 0 <= scene <= 15 and scene in self.scenes:
             old = self.level
@@ -202,17 +246,40 @@ class Group:
                 retain=True,
             )
 
+    def _rampLevelMQTT(self, level, old_level, duration):
+        if old_level == 0:
+            self.mqtt.publish(
+                MQTT_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
+                MQTT_PAYLOAD_ON,
+                retain=True,
+            )
+        RampPublisher().start(
+            self.device_name,
+            old_level,
+            level,
+            duration,
+            lambda x: self.mqtt.publish(
+                MQTT_BRIGHTNESS_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
+                x,
+                retain=True,
+            ),
+            # The on state was published when the ramp started, only off is left to publish
+            lambda: self._sendLevelMQTT(level, level),
+        )
+
     def setSceneToNoneMQTT(self):
         self.mqtt.publish(
             MQTT_SCENE_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name), "-", retain=True)
 
-    def _sendLevelDALI(self, level):
+    def _sendLevelDALI(self, level, transition=None):
+        self.setFadeTime(transition)
         if level != 0:
             level = normalize(level, 0, 255, self.min_levels, self.max_level)
         self.driver.send(gear.DAPC(self.dali_group, level))
         logger.info(f"Set {self.friendly_name} brightness level to {self.level} ({level})")
 
     def _sendSceneDALI(self, scene):
+        self.setFadeTime(None)
         self.driver.send(gear.GoToScene(self.dali_group, scene))
         logger.info(f"Call scene {scene} on {self.friendly_name}")
 
@@ -220,9 +287,11 @@ class Group:
         logger.info(f"Flash group {self.friendly_name}: Count: {count}, Speed {speed}")
         for n in range(count):
             self.driver.send(gear.RecallMaxLevel(self.dali_group))
-            time.sleep(speed)
+            with unlocked():
+                time.sleep(speed)
             self.driver.send(gear.RecallMinLevel(self.dali_group))
-            time.sleep(speed)
+            with unlocked():
+                time.sleep(speed)
 
         if self.level >= 127:
             self.driver.send(gear.RecallMaxLevel(self.dali_group))
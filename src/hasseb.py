@@ -0,0 +1,80 @@
+"""Hasseb DALI USB driver with pipelined queries and paced frames."""
+import struct
+import time
+
+from dali.driver.hasseb import SyncHassebDALIUSBDriver, HASSEB_DALI_FRAME
+from dali.frame import BackwardFrame
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class PipelinedSyncHassebDALIUSBDriver(SyncHassebDALIUSBDriver):
+    """Hasseb driver which can have several frames in flight.
+
+    Every frame written to the adapter carries a sequence number which the
+    adapter echoes in its answer, so the answers of a batch are matched back
+    to their commands instead of waiting for each round trip. pacing seconds
+    are added between the frames, for adapters overrun by them.
+    Instead of sleeping 20 ms before every frame, a frame only waits for
+    what is left of HASSEB_FRAME_INTERVAL since the answer (or the report
+    that nobody answered) of the previous query, or of
+    HASSEB_COMMAND_INTERVAL since a frame without answer was written.
+    """
+
+    pacing = 0.0
+    _next_frame = 0.0
+
+    def send(self, command):
+        self._wait()
+        self._response_message = None
+        data = self.construct(command)
+        self.send_message = struct.pack("BB", data[7], data[8])
+        if command.response is None:
+            self._pending = None
+            self.device.write(data)
+            self._sent(HASSEB_COMMAND_INTERVAL)
+            return None
+        self._pending = command
+        self.device.write(data)
+        self.wait_for_response()
+        self._sent(HASSEB_FRAME_INTERVAL)
+        return command.response(self.extract(self._response_message))
+
+    def _wait(self):
+        wait = self._next_frame - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _sent(self, interval):
+        self._next_frame = time.monotonic() + interval + self.pacing
+
+    def send_many(self, commands):
+        self._wait()
+        responses = [None] * len(commands)
+        pending = {}
+        for index, command in enumerate(commands):
+            data = self.construct(command)
+            if command.response is not None:
+                pending[data[2]] = index
+            self.device.write(data)
+            # Leave the bus the time to carry the frame before queueing the next one
+            time.sleep(HASSEB_FRAME_INTERVAL + self.pacing)
+
+        for _ in range(HASSEB_READ_ATTEMPTS * max(len(pending), 1)):
+            if not pending:
+                break
+            data = self.device.read(10)
+            if not data or len(data) < 6 or data[1] != HASSEB_DALI_FRAME or data[2] not in pending:
+                continue
+            index = pending.pop(data[2])
+            frame = self.extract(data)
+            responses[index] = commands[index].response(frame if isinstance(frame, BackwardFrame) else None)
+
+        for sn, index in pending.items():
+            logger.debug("No answer for %s (sequence number %d)", commands[index], sn)
+            responses[index] = commands[index].response(None)
+        self._sent(HASSEB_FRAME_INTERVAL)
+        return responses
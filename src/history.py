@@ -0,0 +1,174 @@
+"""Local history of the light levels and bus events."""
+import queue
+import sqlite3
+import threading
+import time
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS levels (ts REAL NOT NULL, device TEXT NOT NULL, level INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS levels_device_ts ON levels (device, ts);
+CREATE INDEX IF NOT EXISTS levels_ts ON levels (ts);
+CREATE TABLE IF NOT EXISTS events (ts REAL NOT NULL, kind TEXT NOT NULL, subject TEXT, detail TEXT);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+"""
+
+
+def connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    # Must be set before the tables are created so the retention can give the space back
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def query(db, kind="levels", subject=None, since=None, until=None, limit=HISTORY_QUERY_LIMIT):
+    """Rows of kind between the since and until timestamps, oldest first, as dicts.
+
+    subject is the device of the levels, the topic of the commands or the
+    state of the bus events.
+    """
+    if kind not in ("levels", "events"):
+        raise ValueError(f"unknown kind {kind}")
+    columns = ["ts", "device", "level"] if kind == "levels" else ["ts", "kind", "subject", "detail"]
+    conditions, parameters = [], []
+    for condition, value in ((f"{columns[-2]} = ?", subject), ("ts >= ?", since), ("ts < ?", until)):
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    sql = f"SELECT {', '.join(columns)} FROM {kind}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY ts LIMIT ?"
+    # SQLite reads a negative limit as no limit at all
+    parameters.append(min(max(limit, 1), HISTORY_QUERY_LIMIT))
+    return [dict(zip(columns, row)) for row in db.execute(sql, parameters)]
+
+
+class History:
+    """SQLite history written in batches by a background thread.
+
+    record_level() and record_event() only queue the row, the writer
+    inserts whatever was queued every HISTORY_FLUSH_INTERVAL seconds in a
+    single transaction. Rows are dropped rather than blocking when the
+    writer is behind. Once an hour the levels older than
+    HISTORY_DOWNSAMPLE_AGE are reduced to the last one per device and
+    HISTORY_DOWNSAMPLE_BUCKET seconds, and the oldest rows are deleted while
+    the database is larger than max_size MB.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.dropped = 0
+        self._queue = queue.Queue(HISTORY_QUEUE_SIZE)
+        self._downsampled = 0
+        self._reader = connect(path)
+        self._reader_lock = threading.Lock()
+        threading.Thread(target=self._run, name="history", daemon=True).start()
+
+    def record_level(self, device, level):
+        self._put(("levels", (time.time(), device, level)))
+
+    def record_event(self, kind, subject=None, detail=None):
+        self._put(("events", (time.time(), kind, subject, detail)))
+
+    def _put(self, row):
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def listener(self, base_topic):
+        """StatePublisher listener recording the published brightness of every light."""
+        prefix, suffix = MQTT_BRIGHTNESS_STATE_TOPIC.format(base_topic, "\0").split("\0")
+
+        def record(topic, payload):
+            if topic.startswith(prefix) and topic.endswith(suffix):
+                try:
+                    self.record_level(topic[len(prefix):-len(suffix)], int(payload))
+                except (TypeError, ValueError):
+                    pass
+
+        return record
+
+    def query(self, **kwargs):
+        with self._reader_lock:
+            return query(self._reader, **kwargs)
+
+    def _run(self):
+        db = connect(self.path)
+        next_maintenance = time.monotonic()
+        while True:
+            time.sleep(HISTORY_FLUSH_INTERVAL)
+            try:
+                self._flush(db)
+                if time.monotonic() >= next_maintenance:
+                    next_maintenance = time.monotonic() + HISTORY_MAINTENANCE_INTERVAL
+                    self._downsample(db)
+                    self._enforce_retention(db)
+            except sqlite3.Error as err:
+                logger.error(f"Failed to write the history: {err}")
+
+    def _flush(self, db):
+        rows = {"levels": [], "events": []}
+        try:
+            while True:
+                kind, row = self._queue.get_nowait()
+                rows[kind].append(row)
+        except queue.Empty:
+            pass
+        if not rows["levels"] and not rows["events"]:
+            return
+        with db:
+            db.executemany("INSERT INTO levels VALUES (?, ?, ?)", rows["levels"])
+            db.executemany("INSERT INTO events VALUES (?, ?, ?, ?)", rows["events"])
+        if self.dropped:
+            logger.warning(f"{self.dropped} history rows dropped, the writer is behind")
+            self.dropped = 0
+
+    def _downsample(self, db):
+        # Bucket aligned, so a bucket is never split across two runs
+        cutoff = (time.time() - HISTORY_DOWNSAMPLE_AGE) // HISTORY_DOWNSAMPLE_BUCKET * HISTORY_DOWNSAMPLE_BUCKET
+        if cutoff <= self._downsampled:
+            return
+        with db:
+            deleted = db.execute(
+                "DELETE FROM levels WHERE ts >= ?1 AND ts < ?2 AND rowid NOT IN ("
+                "SELECT MAX(rowid) FROM levels WHERE ts >= ?1 AND ts < ?2 GROUP BY device, CAST(ts / ?3 AS INTEGER))",
+                (self._downsampled, cutoff, HISTORY_DOWNSAMPLE_BUCKET),
+            ).rowcount
+        self._downsampled = cutoff
+        logger.debug(f"Downsampled {deleted} history levels")
+
+    def _size(self, db):
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        pages = db.execute("PRAGMA page_count").fetchone()[0] - db.execute("PRAGMA freelist_count").fetchone()[0]
+        return pages * page_size
+
+    def _enforce_retention(self, db):
+        deleted = False
+        while self._size(db) > self.max_size:
+            with db:
+                removed = sum(
+                    db.execute(
+                        f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY ts LIMIT ?)",
+                        (HISTORY_RETENTION_CHUNK,),
+                    ).rowcount
+                    for table in ("levels", "events")
+                )
+            if not removed:
+                break
+            deleted = True
+        if deleted:
+            # execute() would only run the first step, freeing a single page
+            db.executescript("PRAGMA incremental_vacuum")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            logger.info(f"History trimmed to {self._size(db)} bytes")
+
@@ -3,19 +3,28 @@ import json
 import time
 
 import dali.gear.general as gear
+from dali.exceptions import MissingResponse
 
+from .addresshealth import AddressHealth
 from .config import Config
 from .consts import *
 
 from .devicesnamesconfig import DevicesNamesConfig
 from .functions import normalize
+from .transaction import unlocked
+from .transition import FADE_TIMES, RampPublisher, fade_time_for
 
 logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
 
 class Lamp:
-    def __init__(self, driver, mqtt, dali_lamp):
+    def __init__(self, driver, mqtt, dali_lamp, level=None, parameters=None):
+        """Read the lamp from the bus, except what is known already (warm start).
+
+        level is a known actual level, parameters the entry of the lamp in
+        the retained inventory, with its limits, fade time and scenes.
+        """
         self.config = Config()
         logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
 
@@ -24,38 +33,62 @@ class Lamp:
         self.dali_lamp = dali_lamp
         self.address = dali_lamp.address
 
-        self.friendly_name = DevicesNamesConfig().get_friendly_name(f"DALI Lamp {self.address}")
         self.device_name = f"lamp_{self.address}"
+        self.friendly_name = DevicesNamesConfig().get_friendly_name(self.device_name, f"DALI Lamp {self.address}")
 
         self.current_scene = None
-        _scenes = []
-        for i in range(0, 16):
-            v = driver.send(gear.QuerySceneLevel(self.dali_lamp, i)).value
-            _scenes.append(v)
-        self.scenes = _scenes
+        self.last_change = 0
+        commands = [] if parameters else (
+            [gear.QuerySceneLevel(self.dali_lamp, i) for i in range(0, 16)]
+            + [
+                gear.QueryPhysicalMinimum(self.dali_lamp),
+                gear.QueryMinLevel(self.dali_lamp),
+                gear.QueryMaxLevel(self.dali_lamp),
+                gear.QueryFadeTimeFadeRate(self.dali_lamp),
+            ]
+        )
+        if level is None:
+            commands.append(gear.QueryActualLevel(self.dali_lamp))
+        responses = self.driver.query_many(commands, BUS_PRIORITY_SCAN) if commands else []
+        if any(x.raw_value is None or x.raw_value.error for x in responses):
+            raise MissingResponse(f"lamp {self.address} did not answer every query")
+
+        if parameters:
+            self.scenes = list(parameters["scenes"])
+            self.min_physical_level = parameters["physical_minimum"]
+            self.min_level = parameters["min_level"]
+            self.max_level = parameters["max_level"]
+            self.default_fade_time = parameters["fade_time"]
+        else:
+            self.scenes = [x.value for x in responses[:16]]
+            self.min_physical_level, self.min_level, self.max_level = [x.value for x in responses[16:19]]
+            # Fade time programmed in the gear, transitions change it and commands without one restore it
+            self.default_fade_time = responses[19].fade_time or 0
         logger.debug(f"Scenes: {json.dumps(self.scenes)}")
 
         self.groups = []
 
-        self.min_physical_level = self.driver.send(gear.QueryPhysicalMinimum(self.dali_lamp)).value
-        self.min_level = self.driver.send(gear.QueryMinLevel(self.dali_lamp)).value
         self.min_levels = max(self.min_physical_level, self.min_level)
-        self.max_level = self.driver.send(gear.QueryMaxLevel(self.dali_lamp)).value
+        self.fade_time = self.default_fade_time
 
-        self._getLevelDALI()
+        # A known level is already retained by the broker, it is verified by the poller later
+        self.level = level
+        if level is None:
+            self._setLevelFromDALI(responses[-1].value)
         self._register_discovery()
         self.setSceneToNoneMQTT()
 
-        self.mqtt.publish(
-            MQTT_BRIGHTNESS_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
-            self.level,
-            retain=True,
-        )
-        self.mqtt.publish(
-            MQTT_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
-            MQTT_PAYLOAD_ON if self.level > 0 else MQTT_PAYLOAD_OFF,
-            retain=True,
-        )
+        if level is None:
+            self.mqtt.publish(
+                MQTT_BRIGHTNESS_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
+                self.level,
+                retain=True,
+            )
+            self.mqtt.publish(
+                MQTT_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
+                MQTT_PAYLOAD_ON if self.level > 0 else MQTT_PAYLOAD_OFF,
+                retain=True,
+            )
         logger.info(
             "   - short address: %d, actual brightness level: %d (minimum: %d, max: %d, physical minimum: %d)",
             self.address,
@@ -73,24 +106,30 @@ class Lamp:
     def addGroup(self, group):
         self.groups.append(group)
 
+    def updateFriendlyName(self):
+        """Pick up a changed friendly name, republishing the discovery only when it changed."""
+        friendly_name = DevicesNamesConfig().get_friendly_name(self.device_name, f"DALI Lamp {self.address}")
+        if friendly_name == self.friendly_name:
+            return False
+        logger.info(f"Rename {self.friendly_name} to {friendly_name}")
+        self.friendly_name = friendly_name
+        self._register_discovery()
+        return True
+
     def _register_discovery(self):
         json_config = {
             "name": self.friendly_name,
             "unique_id": f"{self.config[CONF_MQTT_BASE_TOPIC]}_{self.device_name}",
-            "state_topic": MQTT_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
-            "command_topic": MQTT_COMMAND_TOPIC.format(
+            "schema": "template",
+            "state_topic": MQTT_BRIGHTNESS_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
+            "command_topic": MQTT_BRIGHTNESS_COMMAND_TOPIC.format(
                 self.config[CONF_MQTT_BASE_TOPIC], self.device_name
             ),
-            "payload_off": MQTT_PAYLOAD_OFF.decode("utf-8"),
-            "brightness_state_topic": MQTT_BRIGHTNESS_STATE_TOPIC.format(
-                self.config[CONF_MQTT_BASE_TOPIC], self.device_name
-            ),
-            "brightness_command_topic": MQTT_BRIGHTNESS_COMMAND_TOPIC.format(
-                self.config[CONF_MQTT_BASE_TOPIC], self.device_name
-            ),
-            "brightness_scale": 255,
-            "on_command_type": "brightness",
-            "availability_topic": MQTT_DALI2MQTT_STATUS.format(self.config[CONF_MQTT_BASE_TOPIC]),
+            "command_on_template": HA_COMMAND_ON_TEMPLATE,
+            "command_off_template": HA_COMMAND_OFF_TEMPLATE,
+            "state_template": HA_STATE_TEMPLATE,
+            "brightness_template": HA_BRIGHTNESS_TEMPLATE,
+            "availability_topic": self.config.availability_topic,
             "payload_available": MQTT_AVAILABLE,
             "payload_not_available": MQTT_NOT_AVAILABLE,
             "device": {
@@ -116,7 +155,7 @@ class Lamp:
                 self.config[CONF_MQTT_BASE_TOPIC], self.device_name
             ),
             "options": [],
-            "availability_topic": MQTT_DALI2MQTT_STATUS.format(self.config[CONF_MQTT_BASE_TOPIC]),
+            "availability_topic": self.config.availability_topic,
             "payload_available": MQTT_AVAILABLE,
             "payload_not_available": MQTT_NOT_AVAILABLE,
             "device": {
@@ -139,20 +178,34 @@ class Lamp:
             retain=True,
         )
 
-    def setLevel(self, level, dali=True):
+    def setLevel(self, level, dali=True, transition=None):
         if self.level == level:
             return
         old = self.level
         self.level = level
+        self.last_change = time.monotonic()
 
         if dali:
             for _x in self.groups:
                 _x.recalc_level()
-            self._sendLevelDALI(level)
+            self._sendLevelDALI(level, transition)
+
+        if transition:
+            self._rampLevelMQTT(level, old, FADE_TIMES[fade_time_for(transition)])
+        else:
+            RampPublisher().cancel(self.device_name)
+            self._sendLevelMQTT(level, old)
 
-        self._sendLevelMQTT(level, old)
+    def setFadeTime(self, fade_time):
+        """Program the fade time of the gear, unless it already has it."""
+        if self.fade_time == fade_time:
+            return
+        self.driver.send_sequence([gear.DTR0(fade_time), gear.SetFadeTime(self.dali_lamp)])
+        self.fade_time = fade_time
+        logger.debug(f"Set {self.friendly_name} fade time to {FADE_TIMES[fade_time]:.1f}s ({fade_time})")
 
     def setScene(self, scene, dali=True):
+        RampPublisher().cancel(self.device_name)
         self.setSceneToNoneMQTT()
         if 0 <= scene <= 15 and self.scenes[scene] != "MASK":
             level = self.scenes[scene]
@@ -165,6 +218,7 @@ class Lamp:
             if self.level != level:
                 old = self.level
                 self.level = level
+                self.last_change = time.monotonic()
                 if dali:
                     for _x in self.groups:
                         _x.recalc_level()
@@ -185,13 +239,38 @@ class Lamp:
                 retain=True,
             )
 
+    def _rampLevelMQTT(self, level, old_level, duration):
+        if old_level == 0:
+            self.mqtt.publish(
+                MQTT_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
+                MQTT_PAYLOAD_ON,
+                retain=True,
+            )
+        RampPublisher().start(
+            self.device_name,
+            old_level,
+            level,
+            duration,
+            lambda x: self.mqtt.publish(
+                MQTT_BRIGHTNESS_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
+                x,
+                retain=True,
+            ),
+            # The on state was published when the ramp started, only off is left to publish
+            lambda: self._sendLevelMQTT(level, level),
+        )
+
     def setSceneToNoneMQTT(self):
         self.mqtt.publish(
             MQTT_SCENE_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name), "-", retain=True)
 
-    def pollLevel(self):
+    def pollLevel(self, level=None):
+        """Refresh the level from the bus, or from an actual level already queried."""
         old = self.level
-        self._getLevelDALI()
+        if level is None:
+            self._getLevelDALI()
+        else:
+            self._setLevelFromDALI(level)
         if old != self.level:
             self.mqtt.publish(
                 MQTT_BRIGHTNESS_STATE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC], self.device_name),
@@ -204,17 +283,36 @@ class Lamp:
                 retain=True,
             )
 
-    def _sendLevelDALI(self, level):
-        level = normalize(level, 0, 255, self.min_levels, self.max_level)
+    def arcLevel(self, level):
+        """DALI arc power level sent for a brightness, 0 being off."""
+        if level == 0:
+            return 0
+        return normalize(level, 0, 255, self.min_levels, self.max_level)
+
+    def _sendLevelDALI(self, level, transition=None):
+        self.setFadeTime(self.default_fade_time if transition is None else fade_time_for(transition))
+        level = self.arcLevel(level)
         self.driver.send(gear.DAPC(self.dali_lamp, level))
         logger.info(f"Set {self.friendly_name} brightness level to {self.level} ({level})")
 
+    def restoreLevel(self):
+        """Send the known level again, e.g. to gear which missed commands while the driver was reopened."""
+        if self.level is None:
+            return
+        self.driver.send(gear.DAPC(self.dali_lamp, self.arcLevel(self.level)), BUS_PRIORITY_READBACK)
+
     def _sendSceneDALI(self, scene):
+        self.setFadeTime(self.default_fade_time)
         self.driver.send(gear.GoToScene(self.dali_lamp, scene))
         logger.info(f"Call scene {scene} on {self.friendly_name}")
 
     def _getLevelDALI(self):
-        level = self.driver.send(gear.QueryActualLevel(self.dali_lamp)).value
+        response = self.driver.send(gear.QueryActualLevel(self.dali_lamp), BUS_PRIORITY_READBACK)
+        if not AddressHealth().check(self.address, response):
+            raise MissingResponse(f"lamp {self.address} did not answer")
+        self._setLevelFromDALI(response.value)
+
+    def _setLevelFromDALI(self, level):
         if level == 0:
             self.level = 0
         else:
@@ -225,9 +323,11 @@ class Lamp:
         logger.info(f"Flash lamp {self.friendly_name}: Count: {count}, Speed {speed}")
         for n in range(count):
             self.driver.send(gear.RecallMaxLevel(self.dali_lamp))
-            time.sleep(speed)
+            with unlocked():
+                time.sleep(speed)
             self.driver.send(gear.RecallMinLevel(self.dali_lamp))
-            time.sleep(speed)
+            with unlocked():
+                time.sleep(speed)
 
         if self.level >= 127:
             self.driver.send(gear.RecallMaxLevel(self.dali_lamp))
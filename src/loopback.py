@@ -0,0 +1,157 @@
+"""In-process stand-in for an MQTT broker and client."""
+import queue
+import threading
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+def topic_matches_sub(sub, topic):
+    """Check whether a topic matches a subscription with + and # wildcards."""
+    sub_levels = sub.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(sub_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+class LoopbackMessage:
+    def __init__(self, topic, payload, qos=0, retain=False, properties=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.properties = properties
+
+
+class LoopbackClient:
+    """Client with the parts of the paho API the bridge uses, and the broker built in.
+
+    Messages are delivered to the callbacks by the network loop thread like
+    paho does. Other code plays the rest of the MQTT world with inject(),
+    and sees everything the bridge publishes through add_listener().
+    """
+
+    def __init__(self, client_id="", userdata=None):
+        self.client_id = client_id
+        self._userdata = userdata
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.retained = {}
+        self._callbacks = []
+        self._subscriptions = set()
+        self._listeners = []
+        self._queue = queue.Queue()
+        self._connected = False
+        self._thread = None
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def will_set(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self._will = LoopbackMessage(topic, self._encode(payload), qos, retain, properties)
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def message_callback_add(self, sub, callback):
+        self._callbacks.append((sub, callback))
+
+    def message_callback_remove(self, sub):
+        self._callbacks = [_x for _x in self._callbacks if _x[0] != sub]
+
+    def add_listener(self, listener):
+        """Call listener(message) for every message published by the bridge."""
+        self._listeners.append(listener)
+
+    def is_connected(self):
+        return self._connected
+
+    def connect(self, host="localhost", port=1883, keepalive=60, **kwargs):
+        self._queue.put(("connect", None))
+
+    def disconnect(self):
+        self._queue.put(("disconnect", None))
+
+    def subscribe(self, topic, qos=0, **kwargs):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        for sub, _ in topics:
+            self._subscriptions.add(sub)
+            for message in list(self.retained.values()):
+                if topic_matches_sub(sub, message.topic):
+                    self._queue.put(("message", message))
+
+    def unsubscribe(self, topic, **kwargs):
+        for sub in topic if isinstance(topic, list) else [topic]:
+            self._subscriptions.discard(sub)
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        message = LoopbackMessage(topic, self._encode(payload), qos, retain, properties)
+        if retain:
+            self.retained[topic] = message
+        for listener in self._listeners:
+            listener(message)
+        if any(topic_matches_sub(sub, topic) for sub in self._subscriptions):
+            self._queue.put(("message", message))
+
+    def inject(self, topic, payload=None, retain=False, properties=None):
+        """Publish a message from another client of the broker."""
+        message = LoopbackMessage(topic, self._encode(payload), 0, retain, properties)
+        if retain:
+            self.retained[topic] = message
+        if any(topic_matches_sub(sub, topic) for sub in self._subscriptions):
+            self._queue.put(("message", message))
+
+    def loop_forever(self, *args, **kwargs):
+        while True:
+            event, message = self._queue.get()
+            if event == "connect":
+                self._connected = True
+                if self.on_connect is not None:
+                    self.on_connect(self, self._userdata, {}, 0)
+            elif event == "disconnect":
+                self._connected = False
+                if self.on_disconnect is not None:
+                    self.on_disconnect(self, self._userdata, 0)
+                return
+            else:
+                self._dispatch(message)
+
+    def loop_start(self):
+        self._thread = threading.Thread(target=self.loop_forever, name="loopback-mqtt", daemon=True)
+        self._thread.start()
+
+    def loop_stop(self):
+        self.disconnect()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _dispatch(self, message):
+        matched = False
+        for sub, callback in self._callbacks:
+            if topic_matches_sub(sub, message.topic):
+                matched = True
+                self._call(callback, message)
+        if not matched and self.on_message is not None:
+            self._call(self.on_message, message)
+
+    def _call(self, callback, message):
+        try:
+            callback(self, self._userdata, message)
+        except Exception as err:
+            logger.exception("Callback for %s failed: %s", message.topic, err)
+
+    @staticmethod
+    def _encode(payload):
+        if payload is None:
+            return b""
+        if isinstance(payload, (bytes, bytearray)):
+            return bytes(payload)
+        return str(payload).encode("utf-8")
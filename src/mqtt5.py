@@ -0,0 +1,107 @@
+"""MQTT v5 client, with topic aliases for the state topics and correlation of commands."""
+import threading
+from collections import OrderedDict
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from .config import Config
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+# Correlation of the command handled by the current thread, echoed on the state it publishes
+_command = threading.local()
+
+
+def command_callback(callback):
+    """Wrap the callback of a command topic.
+
+    Retained commands are stale by definition and dropped. The correlation
+    data and the correlation id user property of the command are kept for
+    the state topics published while handling it.
+    """
+
+    def wrapper(mqtt_client, data_object, msg):
+        if msg.retain:
+            logger.warning(f"Dropping retained command on {msg.topic}")
+            return
+        properties = getattr(msg, "properties", None)
+        _command.correlation_data = getattr(properties, "CorrelationData", None)
+        _command.correlation_id = dict(getattr(properties, "UserProperty", [])).get(MQTT_CORRELATION_PROPERTY)
+        try:
+            callback(mqtt_client, data_object, msg)
+        finally:
+            _command.correlation_data = None
+            _command.correlation_id = None
+
+    return wrapper
+
+
+class AliasingClient(mqtt.Client):
+    """MQTT v5 client sending the frequently published state topics as topic aliases.
+
+    Aliases are assigned to state topics as they are published, up to the
+    maximum the broker allows, the least recently used one being reassigned
+    when they run out. The first publish on an alias carries the topic, the
+    next ones only the alias.
+    """
+
+    def __init__(self, client_id):
+        super().__init__(client_id=client_id, protocol=mqtt.MQTTv5)
+        self.config = Config()
+        logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
+
+        self.alias_maximum = 0
+        self._aliases = OrderedDict()
+        self._alias_lock = threading.Lock()
+
+    def connect(self, host, port=1883, keepalive=60, **kwargs):
+        # Never resume a session, commands queued by the broker meanwhile would be applied late
+        return super().connect(host, port, keepalive, clean_start=True, **kwargs)
+
+    def connected(self, properties):
+        """Reset the aliases for a new connection, whose CONNACK had properties."""
+        with self._alias_lock:
+            self.alias_maximum = getattr(properties, "TopicAliasMaximum", 0)
+            self._aliases.clear()
+        logger.debug(f"Broker allows {self.alias_maximum} topic aliases")
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        correlation_data = getattr(_command, "correlation_data", None)
+        correlation_id = getattr(_command, "correlation_id", None)
+        if correlation_data is not None or correlation_id is not None:
+            properties = properties or Properties(PacketTypes.PUBLISH)
+            if correlation_data is not None:
+                properties.CorrelationData = correlation_data
+            if correlation_id is not None:
+                properties.UserProperty = (MQTT_CORRELATION_PROPERTY, correlation_id)
+
+        # Messages with QoS > 0 may be resent on another connection, where the alias means nothing
+        if qos != 0 or not topic.endswith(MQTT_ALIASED_TOPICS_SUFFIX):
+            return super().publish(topic, payload, qos, retain, properties)
+
+        # The alias must reach the broker with its topic before it is used alone
+        with self._alias_lock:
+            if self.alias_maximum == 0:
+                return super().publish(topic, payload, qos, retain, properties)
+            alias = self._aliases.get(topic)
+            if alias is not None:
+                self._aliases.move_to_end(topic)
+                send_topic = ""
+            else:
+                used = set(self._aliases.values())
+                if len(used) < self.alias_maximum:
+                    alias = next(x for x in range(1, self.alias_maximum + 1) if x not in used)
+                else:
+                    _, alias = self._aliases.popitem(last=False)
+                self._aliases[topic] = alias
+                send_topic = topic
+            properties = properties or Properties(PacketTypes.PUBLISH)
+            properties.TopicAlias = alias
+            info = super().publish(send_topic, payload, qos, retain, properties)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                self._aliases.pop(topic, None)
+            return info
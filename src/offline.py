@@ -0,0 +1,81 @@
+"""Compact buffering of what is published while the broker is unreachable."""
+import threading
+import time
+from collections import OrderedDict
+
+from .config import Config
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+def _size(topic, payload):
+    if payload is None:
+        return len(topic)
+    return len(topic) + len(payload if isinstance(payload, (bytes, bytearray, str)) else str(payload))
+
+
+class OfflineBuffer:
+    """Client keeping only the last message of each topic while disconnected.
+
+    Instead of letting paho queue every publish during an outage, the
+    messages are kept in the order their topic was last written, up to
+    max_size KB, the least recently written topics being dropped first.
+    When connected again they are published in one burst, except the not
+    retained ones older than OFFLINE_MESSAGE_EXPIRY seconds: those are
+    events whose time has passed, unlike the retained state.
+    Everything else is passed on to the wrapped MQTT client.
+    """
+
+    def __init__(self, client, max_size):
+        self.config = Config()
+        logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
+
+        self.client = client
+        self.max_size = max_size * 1024
+        self.online = False
+        self._pending = OrderedDict()
+        self._size = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        with self._lock:
+            if self.online:
+                return self.client.publish(topic, payload, qos, retain, properties)
+            previous = self._pending.pop(topic, None)
+            if previous is not None:
+                self._size -= _size(topic, previous[1])
+            self._pending[topic] = (time.monotonic(), payload, qos, retain, properties)
+            self._size += _size(topic, payload)
+            while self._size > self.max_size and self._pending:
+                dropped, (_, payload, *_) = self._pending.popitem(last=False)
+                self._size -= _size(dropped, payload)
+                self._dropped += 1
+
+    def connected(self):
+        """Publish what was buffered, then everything directly."""
+        with self._lock:
+            pending, self._pending, self._size = self._pending, OrderedDict(), 0
+            expired = 0
+            now = time.monotonic()
+            for topic, (buffered, payload, qos, retain, properties) in pending.items():
+                if not retain and now - buffered > OFFLINE_MESSAGE_EXPIRY:
+                    expired += 1
+                    continue
+                self.client.publish(topic, payload, qos, retain, properties)
+            self.online = True
+            if pending or self._dropped:
+                logger.info(
+                    f"Published {len(pending) - expired} messages buffered while offline, "
+                    f"{expired} expired and {self._dropped} dropped over {self.max_size // 1024} KB"
+                )
+            self._dropped = 0
+
+    def disconnected(self):
+        with self._lock:
+            self.online = False
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
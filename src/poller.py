@@ -0,0 +1,64 @@
+"""Background polling of the lamp levels."""
+import threading
+import time
+from collections import deque
+
+from .config import Config
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class Poller:
+    """Poll the lamps in the background.
+
+    Lamps given to verify(), e.g. the ones seeded from retained state on a
+    warm start, are polled first, POLL_CHUNK_SIZE at a time and
+    POLL_VERIFY_PAUSE seconds apart so they don't load the bus. Besides, all
+    lamps are polled every interval seconds, unless it is 0.
+    poll(lamps) does the polling, of all lamps when lamps is None.
+    """
+
+    def __init__(self, poll, interval):
+        self.config = Config()
+        logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
+
+        self.poll = poll
+        self.interval = interval
+        self._next_poll = time.monotonic() + interval
+        self._pending = deque()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name="dali-poll", daemon=True).start()
+
+    def verify(self, lamps):
+        logger.info(f"Verifying {len(lamps)} lamps in the background")
+        self._pending.extend(lamps)
+        self._wake.set()
+
+    def reschedule(self, interval):
+        """Poll all lamps every interval seconds from now on."""
+        self.interval = interval
+        self._next_poll = time.monotonic() + interval
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            if self._pending:
+                chunk = [self._pending.popleft() for _ in range(min(POLL_CHUNK_SIZE, len(self._pending)))]
+                self._poll(chunk)
+                time.sleep(POLL_VERIFY_PAUSE)
+                continue
+
+            timeout = max(self._next_poll - time.monotonic(), 0) if self.interval else None
+            if self._wake.wait(timeout):
+                self._wake.clear()
+                continue
+            self._poll(None)
+            self._next_poll = time.monotonic() + self.interval
+
+    def _poll(self, lamps):
+        try:
+            self.poll(lamps)
+        except Exception as err:
+            logger.error(f"Polling failed: {err}")
@@ -0,0 +1,147 @@
+"""Status probing of the whole bus with broadcast and group queries."""
+import json
+import threading
+
+import dali.address as address
+import dali.gear.general as gear
+from dali.exceptions import DALIError
+
+from .config import Config
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+PROBES = {
+    "lamp_failure": gear.QueryLampFailure,
+    "gear_failure": gear.QueryControlGearFailure,
+    "power_failure": gear.QueryPowerFailure,
+}
+
+
+def search(driver, query, lamps, groups, foreign=False):
+    """Find the lamps answering yes to query.
+
+    Returns them, whether the bus answered yes and the number of frames it
+    took. Any answer means someone answered yes, a collision of several
+    answers included. The bus is asked at once first, then the groups
+    splitting the lamps still suspected, largest first: the members of a
+    group answering no are cleared, and the only suspected member of a
+    group answering yes is found. The lamps still suspected after that are
+    asked one by one. With foreign, gear outside of lamps is known to
+    answer yes, and only the suspected members of groups answering yes are
+    asked: the others can't be told apart from that gear.
+    """
+    frames = 1
+    if not driver.send(query(address.Broadcast()), BUS_PRIORITY_POLL).value:
+        return set(), False, frames
+
+    suspected = set(lamps)
+    answered = []
+    for group in sorted(groups, key=lambda x: len(x.lamps), reverse=True):
+        members = suspected & set(group.lamps)
+        if not members or members == suspected:
+            continue
+        frames += 1
+        if driver.send(query(group.dali_group), BUS_PRIORITY_POLL).value:
+            answered.append(group)
+        else:
+            suspected -= members
+
+    found = set()
+    for group in answered:
+        members = suspected & set(group.lamps)
+        if len(members) == 1:
+            found |= members
+    left = suspected - found
+    if foreign:
+        left &= {_x for group in answered for _x in group.lamps}
+    left = list(left)
+    responses = driver.query_many(
+        [query(_x.dali_lamp) for _x in left], BUS_PRIORITY_POLL, return_exceptions=True
+    )
+    frames += len(left)
+    found.update(_x for _x, response in zip(left, responses) if not isinstance(response, Exception) and response.value)
+    return found, True, frames
+
+
+class Prober:
+    """Probe the lamps for failures every interval seconds, unless it is 0, and when requested.
+
+    The lamps answering each of PROBES are published on the probe topic.
+    The ones which saw a power failure are back at their power on level,
+    poll(lamps) reads their actual level, which is sent back to them to
+    clear their power failure flag. When the bus answers yes to a probe but
+    none of the lamps does, gear missing from the inventory answers, and
+    the next searches only ask the lamps a group narrowed down.
+    """
+
+    def __init__(self, data_object, client, poll, interval):
+        self.config = Config()
+        logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
+
+        self.data_object = data_object
+        self.client = client
+        self.poll = poll
+        self.interval = interval
+        self._rescheduled = False
+        # Probes answered by gear outside of the inventory
+        self._foreign = set()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name="dali-probe", daemon=True).start()
+
+    def request(self):
+        self._wake.set()
+
+    def reschedule(self, interval):
+        """Probe every interval seconds from now on."""
+        self.interval = interval
+        self._rescheduled = True
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval or None)
+            self._wake.clear()
+            if self._rescheduled:
+                self._rescheduled = False
+                continue
+            try:
+                self.probe()
+            except Exception as err:
+                logger.error(f"Probing failed: {err}")
+
+    def probe(self):
+        lamps = list(self.data_object["all_lamps"].values())
+        if not lamps or not self.data_object["bridging"].is_set():
+            return
+        groups = list(self.data_object["all_groups"].values())
+        result = {}
+        frames = 0
+        for name, query in PROBES.items():
+            found, answered, used = search(self.data_object["driver"], query, lamps, groups, name in self._foreign)
+            frames += used
+            if answered and not found:
+                if name not in self._foreign:
+                    logger.warning(f"Gear missing from the inventory answers {name}")
+                self._foreign.add(name)
+            else:
+                self._foreign.discard(name)
+            result[name] = [_x.device_name for _x in sorted(found, key=lambda x: x.address)]
+            if name == "power_failure" and found:
+                self.poll(list(found))
+                self._acknowledge(found)
+        logger.info(f"Probed {len(lamps)} lamps in {frames} frames")
+        result["frames"] = frames
+        self.client.publish(
+            MQTT_PROBE_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC]), json.dumps(result), retain=True
+        )
+
+    @staticmethod
+    def _acknowledge(lamps):
+        # Any arc power command clears the power failure flag, the level just read leaves the light as it is
+        for lamp in lamps:
+            try:
+                lamp.restoreLevel()
+            except DALIError as err:
+                logger.warning(f"Failed to clear the power failure of {lamp.device_name}: {err}")
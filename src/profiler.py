@@ -0,0 +1,139 @@
+"""Profiling sessions started over MQTT in the running bridge."""
+import cProfile
+import gzip
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from .config import Config
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    """Run one time boxed profiling session at a time.
+
+    Modes:
+    - cprofile: deterministic profile of the command handlers, which run
+      the lamps and groups and wait for the bus,
+    - sample: stacks of every thread, the driver included, sampled every
+      PROFILE_SAMPLE_INTERVAL seconds, in the folded format of flame graphs,
+    - tracemalloc: the lines which allocated the most memory during the
+      session.
+
+    The gzipped text report is published on the result topic, or written
+    to profile_dir when the request asks for a file.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Profiler, cls).__new__(cls)
+            cls._instance.config = Config()
+            cls._instance._profile = None
+            cls._instance._profile_lock = threading.Lock()
+            cls._instance._busy = threading.Lock()
+            logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[cls._instance.config[CONF_LOG_LEVEL]])
+        return cls._instance
+
+    def run(self, function, *args):
+        """Call function, profiled when a cprofile session is running and no other call is profiled."""
+        profile = self._profile
+        if profile is None or not self._profile_lock.acquire(blocking=False):
+            return function(*args)
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            self._profile_lock.release()
+
+    def start(self, client, request):
+        mode = request.get("mode")
+        duration = request.get("duration", PROFILE_DEFAULT_DURATION)
+        top = request.get("top", PROFILE_DEFAULT_TOP)
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"unknown mode {mode}")
+        if not isinstance(duration, (int, float)) or not 0 < duration <= PROFILE_MAX_DURATION:
+            raise ValueError(f"duration must be between 0 and {PROFILE_MAX_DURATION}s")
+        if not isinstance(top, int) or top <= 0:
+            raise ValueError(f"invalid top {top}")
+        if request.get("file") and not self.config[CONF_PROFILE_DIR]:
+            raise ValueError("no profile_dir to write files to")
+        if not self._busy.acquire(blocking=False):
+            raise ValueError("a profiling session is already running")
+        threading.Thread(
+            target=self._session, args=(client, mode, duration, top, bool(request.get("file"))),
+            name="profiler", daemon=True,
+        ).start()
+
+    def _session(self, client, mode, duration, top, to_file):
+        logger.info(f"Profiling ({mode}) for {duration}s")
+        try:
+            report = getattr(self, f"_{mode}")(duration, top)
+            header = f"dali2mqtt {VERSION} {mode} profile of {duration}s at {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+            data = gzip.compress((header + report).encode("utf-8"))
+            base_topic = self.config[CONF_MQTT_BASE_TOPIC]
+            if to_file:
+                path = os.path.join(self.config[CONF_PROFILE_DIR],
+                                    f"dali2mqtt-{mode}-{time.strftime('%Y%m%d-%H%M%S')}.txt.gz")
+                with open(path, "wb") as f:
+                    f.write(data)
+                logger.info(f"Profile written to {path}")
+                client.publish(MQTT_PROFILE_RESULT_TOPIC.format(base_topic), json.dumps({"file": path}))
+            else:
+                client.publish(MQTT_PROFILE_RESULT_TOPIC.format(base_topic), data)
+        except Exception as err:
+            logger.error(f"Profiling failed: {err}")
+        finally:
+            self._busy.release()
+
+    def _cprofile(self, duration, top):
+        self._profile = cProfile.Profile()
+        time.sleep(duration)
+        # Wait for the handler being profiled, if any
+        with self._profile_lock:
+            profile, self._profile = self._profile, None
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(top)
+        return out.getvalue()
+
+    def _sample(self, duration, top):
+        stacks = Counter()
+        me = threading.get_ident()
+        names = {x.ident: x.name for x in threading.enumerate()}
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stacks[";".join([names.get(ident, str(ident))] + stack[::-1])] += 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+
+    @staticmethod
+    def _tracemalloc(duration, top):
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        time.sleep(duration)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+        lines = [f"traced memory: {current} bytes, peak {peak} bytes", ""]
+        lines.extend(str(x) for x in after.compare_to(before, "lineno")[:top])
+        return "\n".join(lines)
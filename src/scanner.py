@@ -0,0 +1,505 @@
+"""Discovery of lamps and groups on the DALI bus."""
+import json
+import os
+import threading
+import time
+import traceback
+
+import dali.address as address
+import dali.gear.general as gear
+from dali.command import YesNoResponse
+from dali.exceptions import DALIError, MissingResponse
+
+from .addresshealth import AddressHealth
+from .config import Config
+from .group import Group
+from .lamp import Lamp
+from .devicesnamesconfig import DevicesNamesConfig
+from .startup import StartupProfile
+from .transaction import DeferredPublisher, transaction
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class ScanCancelled(Exception):
+    pass
+
+
+def _check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise ScanCancelled()
+
+
+def _report(progress, state, done, total):
+    if progress is not None:
+        progress(state, done, total)
+
+
+def scan_lamps(driver, cancel=None, progress=None, unknown=None):
+    """Scan a maximum number of dali devices, yielding the address of each one as soon as it was found.
+
+    The addresses which didn't tell whether gear is there are added to unknown.
+    """
+    found = 0
+    config = Config()
+    for start in range(0, 64, SCAN_CHUNK_SIZE):
+        _check_cancel(cancel)
+        _report(progress, SCAN_STATE_SCANNING, start, 64)
+        chunk = range(start, min(start + SCAN_CHUNK_SIZE, 64))
+        logger.debug("Search for Lamps %s to %s", chunk[0], chunk[-1])
+        responses = driver.query_many(
+            [gear.QueryControlGearPresent(address.Short(lamp)) for lamp in chunk], BUS_PRIORITY_SCAN,
+            return_exceptions=True,
+        )
+        for lamp, present in zip(chunk, responses):
+            if isinstance(present, DALIError):
+                logger.warning("%s not present: %s", lamp, present)
+                if unknown is not None:
+                    unknown.add(lamp)
+            elif isinstance(present, YesNoResponse) and present.value:
+                found += 1
+                logger.debug("Found lamp at address %d", lamp)
+                yield lamp
+                if found >= config[CONF_DALI_LAMPS]:
+                    logger.warning("All %s configured lamps have been found, Stopping scan", config[CONF_DALI_LAMPS])
+                    logger.info("Found %d lamps", found)
+                    return
+
+    logger.info("Found %d lamps", found)
+
+
+def scan_groups(dali_driver, lamps, cancel=None, unread=None):
+    """Groups of the lamps, the lamps whose groups couldn't be read are added to unread."""
+    logger.info("Scanning for groups:")
+    groups = {}
+    _check_cancel(cancel)
+    responses = dali_driver.query_many(
+        [
+            command(address.Short(lamp))
+            for lamp in lamps
+            for command in (gear.QueryGroupsZeroToSeven, gear.QueryGroupsEightToFifteen)
+        ],
+        BUS_PRIORITY_SCAN,
+        return_exceptions=True,
+    )
+    for index, lamp in enumerate(lamps):
+        try:
+            logger.debug("Search for groups for Lamp {}".format(lamp))
+            group1, group2 = responses[2 * index:2 * index + 2]
+            for response in (group1, group2):
+                if isinstance(response, DALIError):
+                    raise response
+            group1 = group1.value.as_integer
+            group2 = group2.value.as_integer
+
+            lamp_groups = []
+
+            for i in range(8):
+                checkgroup = 1 << i
+                logger.debug("Check pattern: %d", checkgroup)
+                if (group1 & checkgroup) == checkgroup:
+                    if not i in groups:
+                        groups[i] = []
+                    groups[i].append(lamp)
+                    lamp_groups.append(i)
+                if (group2 & checkgroup) != 0:
+                    if not i + 8 in groups:
+                        groups[i + 8] = []
+                    groups[i + 8].append(lamp)
+                    lamp_groups.append(i + 8)
+
+            logger.debug("Lamp %d is in groups %s", lamp, lamp_groups)
+
+        except Exception as e:
+            logger.warning("Can't get groups for lamp %s: %s", lamp, e)
+            if unread is not None:
+                unread.add(lamp)
+    logger.info("Finished scanning for groups")
+    return groups
+
+
+def add_lamp(driver_object, client, inventory, lamp, level=None, cancel=None, parameters=None, added=None):
+    """Read the lamp at short address lamp, and add it to inventory along with its groups.
+
+    A group is created with its first lamp and gets the others as they are added.
+    parameters is the entry of the lamp in a retained inventory, which isn't read again.
+    added(lamp) is called within the transaction adding the lamp.
+    """
+    unread = set()
+    groups = parameters["groups"] if parameters else scan_groups(driver_object, [lamp], cancel, unread)
+    if unread:
+        # Group commands would be applied to the lamps of the group as far as known
+        raise MissingResponse(f"lamp {lamp} did not tell its groups")
+    _lamp = Lamp(driver_object, client, address.Short(lamp), level, parameters)
+
+    # The inventory may be the live one, used by the commands meanwhile
+    with transaction():
+        inventory["all_lamps"][lamp] = _lamp
+        for group in groups:
+            try:
+                _group = inventory["all_groups"].get(group)
+                if _group is None:
+                    _group = Group(driver_object, client, address.Group(group), [_lamp])
+                    inventory["all_groups"][group] = _group
+                else:
+                    _group.addLamp(_lamp)
+                _lamp.addGroup(_group)
+            except Exception as err:
+                logger.error("While initializing group<%s>: %s", group, err)
+                logger.debug(traceback.format_exc())
+        if added is not None:
+            added(_lamp)
+    return _lamp
+
+
+def unaddressed_gear(driver_object):
+    """Whether gear without a short address is on the bus, it can't be controlled on its own nor inventoried."""
+    response = driver_object.query_many(
+        [gear.QueryMissingShortAddress(address.Broadcast())], BUS_PRIORITY_SCAN, return_exceptions=True
+    )[0]
+    if isinstance(response, DALIError):
+        logger.warning(f"Can't tell whether gear lacks a short address: {response}")
+        return True
+    # Colliding answers of several gear are an answer as well
+    return response.raw_value is not None
+
+
+def initialize_lamps(driver_object, client, inventory, cancel=None, progress=None, levels=None, added=None,
+                     parameters=None):
+    """Scan the bus and fill inventory with the lamps and groups found.
+
+    Each lamp is read, grouped and added to inventory as soon as it was
+    found, so it can be used while the rest of the bus is scanned, and
+    added(lamp) is called within the transaction adding it. The addresses
+    of the lamps which failed to be read are kept in inventory["failed_lamps"].
+    levels maps short addresses to levels known already, and parameters to
+    entries of a retained inventory, which aren't read again.
+    Returns whether the scan saw all the gear of the bus, i.e. it didn't
+    stop at dali_lamps and no gear lacks a short address. The addresses
+    which didn't tell whether gear is there are in failed_lamps as well.
+    """
+    levels = levels or {}
+    parameters = parameters or {}
+    logger.info("initializing lamps...")
+    health = AddressHealth()
+    inventory["failed_lamps"] = set()
+    found = 0
+    for lamp in scan_lamps(driver_object, cancel, progress, inventory["failed_lamps"]):
+        found += 1
+        _check_cancel(cancel)
+        _report(progress, SCAN_STATE_READING, lamp, 64)
+        try:
+            add_lamp(driver_object, client, inventory, lamp, levels.get(lamp), cancel, parameters.get(lamp), added)
+            health.succeeded(lamp)
+        except ScanCancelled:
+            raise
+        except Exception as err:
+            # Broken gear is left out and read again later, the rest of the bus is still usable
+            logger.error("While initializing lamp<%s>: %s", lamp, err)
+            logger.debug(traceback.format_exc())
+            health.failed(lamp)
+            inventory["failed_lamps"].add(lamp)
+
+    complete = found < Config()[CONF_DALI_LAMPS] and not unaddressed_gear(driver_object)
+    if not complete:
+        logger.info("Not all the gear of the bus is known, scenes won't stand in for levels")
+    logger.info("initializing lamps finished")
+    return complete
+
+
+class Scanner:
+    """Run lamp (re)initialization in the background.
+
+    A rescan fills a shadow inventory while commands keep going to the live
+    one in data_object, which is swapped for the shadow once the scan is done.
+    The state and discovery of the shadow lights are only published then.
+    The first scan fills the live inventory directly, and the bridge is
+    online from its first lamp. The commands for the lights it didn't read
+    yet are kept meanwhile, and applied once the light was added or the
+    scan ended.
+    A request made while a scan is running restarts that scan, so both
+    requests are served by a single complete pass.
+    The lamps which failed to be read are read again on their AddressHealth
+    schedule, and added to the live inventory once they answer.
+    A scan started from a retained inventory is followed by a rescan, the
+    parameters may have changed while the bridge was down.
+    """
+
+    def __init__(self, data_object, client):
+        self.config = Config()
+        logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
+
+        self.data_object = data_object
+        self.client = client
+
+        self._lock = threading.Lock()
+        self._busy = False
+        self._restart = threading.Event()
+        self._cancelled = False
+        # Commands per light the first scan didn't read yet, while it runs
+        self._deferred = None
+        self._warm_levels = None
+        self._warm_parameters = None
+        self._warm_marker = None
+        self._warm_received = threading.Event()
+        # Whether the last scan saw all the gear of the bus
+        self._complete = False
+        threading.Thread(target=self._retry_failed, name="dali-scan-retry", daemon=True).start()
+
+    @property
+    def running(self):
+        return self._busy
+
+    @property
+    def complete(self):
+        """Whether the live inventory has all the gear of the bus, the lamps which failed to be read included."""
+        return self._complete and not self.data_object.get("failed_lamps")
+
+    def request(self):
+        with self._lock:
+            self._cancelled = False
+            if self._busy:
+                logger.info("Scan already running, restarting it")
+                self._restart.set()
+                return
+            self._busy = True
+            self._restart.clear()
+        threading.Thread(target=self._run, name="dali-scan", daemon=True).start()
+
+    def cancel(self):
+        """Stop the running scan, if any."""
+        with self._lock:
+            if self._busy:
+                self._cancelled = True
+                self._restart.set()
+
+    def collect_retained_state(self):
+        """Listen to the retained levels of the lamps and the inventory, the next scan starts from them.
+
+        A marker is published once subscribed, the broker sends it after the
+        retained messages of the subscriptions, so they have all arrived with it.
+        """
+        base_topic = self.config[CONF_MQTT_BASE_TOPIC]
+        self._warm_levels = {}
+        self._warm_parameters = {}
+        self._warm_marker = f"{os.getpid()}-{time.time()}"
+        self._warm_received.clear()
+        for topic, callback in self._warm_topics():
+            self.client.message_callback_add(topic, callback)
+        self.client.subscribe([(topic, 0) for topic, _ in self._warm_topics()])
+        self.client.publish(MQTT_WARM_START_MARKER_TOPIC.format(base_topic), self._warm_marker)
+
+    def _warm_topics(self):
+        base_topic = self.config[CONF_MQTT_BASE_TOPIC]
+        return [
+            (MQTT_BRIGHTNESS_STATE_TOPIC.format(base_topic, "+"), self._on_retained_level),
+            (MQTT_BRIDGE_DEVICES_TOPIC.format(base_topic), self._on_retained_inventory),
+            (MQTT_WARM_START_MARKER_TOPIC.format(base_topic), self._on_warm_marker),
+        ]
+
+    def _on_retained_level(self, client, data_object, msg):
+        device = msg.topic.split("/")[-3]
+        levels = self._warm_levels
+        if levels is None or not msg.retain or not device.startswith("lamp_"):
+            return
+        try:
+            address, level = int(device[5:]), int(msg.payload)
+        except ValueError:
+            return
+        if 0 <= level <= 255:
+            levels[address] = level
+
+    def _on_retained_inventory(self, client, data_object, msg):
+        parameters = self._warm_parameters
+        if parameters is None or not msg.retain:
+            return
+        try:
+            lamps = json.loads(msg.payload)["lamps"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring the retained inventory, it can't be read")
+            return
+        for lamp in lamps:
+            # Inventories published by older versions lack the fade time, those lamps are read
+            if isinstance(lamp, dict) and WARM_START_PARAMETERS <= lamp.keys() and len(lamp["scenes"]) == 16:
+                parameters[lamp["address"]] = lamp
+
+    def _on_warm_marker(self, client, data_object, msg):
+        if msg.payload.decode(errors="replace") == self._warm_marker:
+            self._warm_received.set()
+
+    def _take_retained_state(self):
+        if self._warm_levels is None:
+            return {}, {}
+        if not self._warm_received.wait(WARM_START_WINDOW):
+            logger.warning("The retained state took too long to arrive, starting from what was received")
+        self.client.unsubscribe([topic for topic, _ in self._warm_topics()])
+        for topic, _ in self._warm_topics():
+            self.client.message_callback_remove(topic)
+        levels, self._warm_levels = self._warm_levels, None
+        parameters, self._warm_parameters = self._warm_parameters, None
+        logger.info(f"Warm start from the retained level of {len(levels)} lamps and parameters of {len(parameters)}")
+        return levels, parameters
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            # Nothing to keep serving on the first scan, the lamps are served as soon as they are found
+            streaming = not self.data_object["all_lamps"]
+            inventory = self.data_object if streaming else {"all_lamps": {}, "all_groups": {}}
+            client = self.client if streaming else DeferredPublisher(self.client)
+            if streaming:
+                self._complete = False
+                with transaction():
+                    self._deferred = {}
+            try:
+                levels, parameters = self._take_retained_state()
+                complete = initialize_lamps(self.data_object["driver"], client, inventory, self._restart,
+                                            self._publish_progress, levels, self._added if streaming else None,
+                                            parameters)
+                self._swap(inventory, started, client)
+                # The scenes of a retained inventory aren't trusted to be complete until read from the bus again
+                self._complete = complete and not parameters
+                if levels and not parameters and "poller" in self.data_object:
+                    self.data_object["poller"].verify(
+                        [_x for _x in inventory["all_lamps"].values() if _x.address in levels]
+                    )
+                StartupProfile().record("scan", started)
+                self._publish_progress(SCAN_STATE_DONE, len(inventory["all_lamps"]), len(inventory["all_lamps"]))
+                if parameters:
+                    # They may have changed while the bridge was down, rescan in the background with the levels
+                    logger.info("Reading the warm started lamps again in the background")
+                    self._restart.set()
+            except ScanCancelled:
+                logger.info("Scan cancelled")
+                self._publish_progress(SCAN_STATE_CANCELLED, 0, 0)
+            except Exception as err:
+                logger.error("Scan failed: %s", err)
+                self._publish_progress(SCAN_STATE_FAILED, 0, 0)
+            if streaming:
+                self._stop_deferring()
+
+            with self._lock:
+                if self._cancelled or not self._restart.is_set():
+                    self._busy = False
+                    self._cancelled = False
+                    self._restart.clear()
+                    return
+                self._restart.clear()
+
+    def _swap(self, inventory, started, client):
+        with transaction():
+            # Commands handled by the live inventory during the scan are newer than what was read from the bus
+            old_lamps = self.data_object["all_lamps"]
+            for lamp in inventory["all_lamps"].values():
+                old = old_lamps.get(lamp.address)
+                if old is not None and old is not lamp and old.last_change > started:
+                    lamp.setLevel(old.level, False)
+            for group in inventory["all_groups"].values():
+                group.recalc_level()
+
+            self.data_object["all_lamps"] = inventory["all_lamps"]
+            self.data_object["all_groups"] = inventory["all_groups"]
+            self.data_object["failed_lamps"] = inventory["failed_lamps"]
+            if isinstance(client, DeferredPublisher):
+                client.flush()
+        if "snapshot" in self.data_object:
+            self.data_object["snapshot"].publish_inventory()
+            self.data_object["snapshot"].changed()
+
+        devices_names_config = DevicesNamesConfig()
+        if devices_names_config.is_devices_file_empty():
+            devices_names_config.save_devices_names_file(
+                list(inventory["all_lamps"].values()) + list(inventory["all_groups"].values()))
+
+        self._online()
+
+    def defer(self, device, replay):
+        """Keep a command for a light the first scan didn't read yet, replay() applies it once the light was added.
+
+        To be called within a transaction(), returns whether the command was kept.
+        """
+        deferred = self._deferred
+        if deferred is None:
+            return False
+        kind, _, number = device.partition("_")
+        if kind not in ("lamp", "group") or not number.isdigit():
+            return False
+        if int(number) in self.data_object["all_lamps" if kind == "lamp" else "all_groups"]:
+            return False
+        if sum(len(_x) for _x in deferred.values()) >= SCAN_DEFERRED_COMMANDS:
+            logger.warning(f"Too many commands for lights not scanned yet, dropping the one for {device}")
+            return False
+        logger.debug(f"{device} isn't scanned yet, keeping its command")
+        deferred.setdefault(device, []).append(replay)
+        return True
+
+    def _added(self, lamp):
+        self._replay([lamp.device_name] + [_x.device_name for _x in lamp.groups])
+        if len(self.data_object["all_lamps"]) == 1:
+            self._online()
+
+    def _replay(self, devices):
+        for device in devices:
+            for replay in self._deferred.pop(device, []):
+                try:
+                    replay()
+                except Exception as err:
+                    logger.error(f"Failed to apply a kept command to {device}: {err}")
+
+    def _stop_deferring(self):
+        # The lights which weren't found get their commands as they would have without the scan
+        with transaction():
+            self._replay(list(self._deferred))
+            self._deferred = None
+
+    def _retry_failed(self):
+        health = AddressHealth()
+        while True:
+            time.sleep(SCAN_RETRY_CHECK)
+            failed = self.data_object.get("failed_lamps")
+            if not failed or self._busy or not self.data_object["bridging"].is_set():
+                continue
+            added = 0
+            for lamp in sorted(failed):
+                if not health.available(lamp):
+                    continue
+                try:
+                    if not self._present(lamp):
+                        logger.info(f"No gear at {lamp} after all")
+                        health.succeeded(lamp)
+                        failed.discard(lamp)
+                        continue
+                    add_lamp(self.data_object["driver"], self.client, self.data_object, lamp)
+                except Exception as err:
+                    logger.debug("Lamp %s still fails: %s", lamp, err)
+                    health.failed(lamp)
+                    continue
+                health.succeeded(lamp)
+                failed.discard(lamp)
+                added += 1
+                logger.info(f"Lamp {lamp} answers, added it")
+            if added and "snapshot" in self.data_object:
+                self.data_object["snapshot"].publish_inventory()
+                self.data_object["snapshot"].changed()
+
+    def _present(self, lamp):
+        response = self.data_object["driver"].query_many(
+            [gear.QueryControlGearPresent(address.Short(lamp))], BUS_PRIORITY_SCAN
+        )[0]
+        return response.value
+
+    def _online(self):
+        self.client.publish(
+            self.config.availability_topic, MQTT_AVAILABLE, retain=True
+        )
+        StartupProfile().online_now()
+
+    def _publish_progress(self, state, done, total):
+        self.client.publish(
+            MQTT_SCAN_PROGRESS_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC]),
+            json.dumps({"state": state, "done": done, "total": total}),
+            retain=True,
+        )
@@ -0,0 +1,128 @@
+"""Levels of several lamps set by scene calls on groups or the whole bus."""
+import threading
+
+import dali.address as address
+import dali.gear.general as gear
+from dali.exceptions import DALIError
+
+from .consts import *
+from .transaction import transaction
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+def _scene_lamps(targets, members, scene):
+    """Lamps among members a scene call sets to their target, None when it would set any wrongly."""
+    covered = set()
+    for lamp in members:
+        level = lamp.scenes[scene]
+        if level == "MASK":
+            continue
+        # A scene fades with the fade time of the gear, which may have been changed by a transition
+        if lamp not in targets or lamp.fade_time != lamp.default_fade_time or lamp.arcLevel(targets[lamp]) != level:
+            return None
+        covered.add(lamp)
+    return covered
+
+
+def plan_scenes(targets, lamps, groups):
+    """Find the scene calls reproducing targets, which maps lamps to a brightness.
+
+    Only calls setting every lamp they change to its target are used, the
+    one covering the most lamps first, as long as it covers 2 lamps not
+    covered yet. lamps and groups must be the whole bus, the broadcast and
+    group calls would otherwise change unknown gear.
+    Returns the calls as (address, scene, lamps) and the lamps left.
+    """
+    options = []
+    for dali_address, members in [(address.Broadcast(), lamps)] + [(_x.dali_group, _x.lamps) for _x in groups]:
+        for scene in range(16):
+            covered = _scene_lamps(targets, members, scene)
+            if covered is not None and len(covered) >= 2:
+                options.append((dali_address, scene, covered))
+
+    left = set(targets)
+    calls = []
+    while options:
+        best = max(options, key=lambda x: len(x[2] & left))
+        if len(best[2] & left) < 2:
+            break
+        options.remove(best)
+        calls.append(best)
+        left -= best[2]
+    return calls, [_x for _x in targets if _x in left]
+
+
+def set_levels(driver, targets, lamps, groups):
+    """Set the lamps of targets to their brightness, with scene calls where they reproduce it.
+
+    The lamps of a scene call which failed are set one by one. Returns the
+    lamps which couldn't be set, mapped to their error.
+    """
+    calls, left = plan_scenes(targets, lamps, groups)
+    affected_groups = set()
+    for dali_address, scene, covered in calls:
+        try:
+            driver.send(gear.GoToScene(dali_address, scene))
+        except DALIError as err:
+            logger.warning(f"Scene {scene} on {dali_address} failed, setting its lamps one by one: {err}")
+            left.extend(_x for _x in targets if _x in covered)
+            continue
+        logger.info(f"Call scene {scene} on {dali_address} for {len(covered)} lamps")
+        for lamp in covered:
+            lamp.setLevel(targets[lamp], False)
+            affected_groups.update(lamp.groups)
+    for _x in affected_groups:
+        _x.recalc_level()
+    failed = {}
+    for lamp in left:
+        try:
+            lamp.setLevel(targets[lamp])
+        except DALIError as err:
+            logger.error(f"Failed to set {lamp.device_name} to {targets[lamp]}: {err}")
+            failed[lamp] = err
+    return failed
+
+
+class LevelCoalescer:
+    """Gather the brightness commands on lamps arriving together, and set them at once with set_levels().
+
+    Home Assistant sends a command per light when a scene or an area is
+    switched, where a scene call on a group or the whole bus may set many
+    of them with a single frame. The targets are gathered for
+    COALESCE_WINDOW seconds from the first one, then apply(targets) is
+    called within a transaction. Other commands call flush() first, so
+    the commands are still applied in the order they came.
+    """
+
+    def __init__(self, apply):
+        self.apply = apply
+        self._targets = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, lamp, level):
+        with self._lock:
+            self._targets[lamp] = level
+            if self._timer is None:
+                self._timer = threading.Timer(COALESCE_WINDOW, self._expired)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Set the gathered targets now, to be called within a transaction()."""
+        with self._lock:
+            targets, self._targets = self._targets, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if targets:
+            self.apply(targets)
+
+    def _expired(self):
+        try:
+            with transaction():
+                self.flush()
+        except Exception as err:
+            logger.error(f"Failed to set the gathered levels: {err}")
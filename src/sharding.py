@@ -0,0 +1,103 @@
+"""Ownership of a DALI line shared by several bridge processes."""
+import json
+import threading
+import time
+
+from .config import Config
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class ShardCoordinator:
+    """Decide which of the shards configured for a line bridges it.
+
+    Every shard announces itself on its own availability topic, with a last
+    will marking it offline, which gives the membership. The owner of the
+    line is the shard named in the retained claim on the owner topic. When
+    there is no claim, or the owner goes offline, the online shard with the
+    lowest id claims the line. The broker keeps the last claim, so shards
+    racing for a line all end up agreeing on the same owner.
+
+    on_acquired() is called when this shard becomes the owner, and on_lost()
+    when another shard took the line over.
+    """
+
+    def __init__(self, client, on_acquired, on_lost):
+        self.config = Config()
+        logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
+
+        self.client = client
+        self.shard_id = self.config[CONF_SHARD_ID]
+        self.on_acquired = on_acquired
+        self.on_lost = on_lost
+        self.members = {}
+        self.owner = None
+        self.owning = False
+        self._lock = threading.RLock()
+
+        base_topic = self.config[CONF_MQTT_BASE_TOPIC]
+        self.owner_topic = MQTT_SHARD_OWNER_TOPIC.format(base_topic)
+        self.members_topic = MQTT_SHARD_STATUS_TOPIC.format(base_topic, "+")
+        client.message_callback_add(self.owner_topic, self._on_owner)
+        client.message_callback_add(self.members_topic, self._on_member)
+
+    def start(self):
+        """Join the line, called on every connection to the broker."""
+        with self._lock:
+            # Subscriptions don't survive a reconnection, the owner has to set them up again
+            self.owning = False
+            self.members = {}
+        self.client.publish(self.config.availability_topic, MQTT_AVAILABLE, retain=True)
+        self.client.subscribe([(self.owner_topic, 1), (self.members_topic, 1)])
+        # Give the broker time to deliver the retained claim and members first
+        timer = threading.Timer(SHARD_CLAIM_DELAY, self._maybe_claim)
+        timer.daemon = True
+        timer.start()
+
+    def stop(self):
+        """Leave the line on a disconnection, the claim may change before start() checks it again."""
+        with self._lock:
+            self.owning = False
+            self.owner = None
+
+    def _on_owner(self, client, data_object, msg):
+        try:
+            owner = json.loads(msg.payload)["shard"] if msg.payload else None
+        except (ValueError, KeyError, TypeError):
+            logger.error(f"Invalid claim on {msg.topic}: {msg.payload}")
+            owner = None
+        with self._lock:
+            self.owner = owner
+            logger.info(f"Line owned by shard {owner}")
+            if owner == self.shard_id and not self.owning:
+                self.owning = True
+                self.on_acquired()
+            elif owner != self.shard_id and self.owning:
+                self.owning = False
+                self.on_lost()
+        if owner is None or not self.members.get(owner, False):
+            self._maybe_claim()
+
+    def _on_member(self, client, data_object, msg):
+        shard = msg.topic.split("/")[-2]
+        online = msg.payload.decode("utf-8") == MQTT_AVAILABLE
+        with self._lock:
+            self.members[shard] = online
+        logger.debug(f"Shard {shard} is {'online' if online else 'offline'}")
+        if shard == self.owner and not online:
+            logger.warning(f"Owner shard {shard} went offline")
+            self._maybe_claim()
+
+    def _maybe_claim(self):
+        with self._lock:
+            if self.owner is not None and self.members.get(self.owner, False):
+                return
+            candidates = sorted(shard for shard, online in self.members.items() if online)
+            if self.shard_id not in candidates or candidates[0] != self.shard_id:
+                return
+        logger.info(f"Claiming the line for shard {self.shard_id}")
+        self.client.publish(
+            self.owner_topic, json.dumps({"shard": self.shard_id, "since": time.time()}), qos=1, retain=True
+        )
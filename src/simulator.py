@@ -0,0 +1,142 @@
+"""Simulated DALI bus, used by the dummy driver and the benchmarks."""
+import threading
+import time
+
+import dali.address as address
+import dali.gear.general as gear
+from dali.frame import BackwardFrame, BackwardFrameError
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class SimulatedGear:
+    """State of a single control gear on the simulated bus."""
+
+    def __init__(self, short_address):
+        self.address = short_address
+        # Eight lamps per group, and every lamp in group 15
+        self.groups = (1 << (short_address // 8)) | (1 << 15)
+        self.scenes = [254, 128, 0] + [255] * 13
+        self.physical_minimum = 1
+        self.min_level = 1
+        self.max_level = 254
+        self.level = 254
+        self.fade_time = 0
+        self.fade_rate = 7
+        self.power_failure = True
+        self.lamp_failure = False
+        self.alive = True
+
+    def set_level(self, level):
+        if level == 255:
+            return
+        if level != 0:
+            level = min(max(level, self.min_level, self.physical_minimum), self.max_level)
+        self.level = level
+        self.power_failure = False
+
+
+class SimulatedDALIDriver:
+    """Driver talking to a simulated bus instead of real hardware.
+
+    The gear answers the queries dali2mqtt uses, and every frame takes
+    frame_time seconds on the bus (half as much again for an answer) so
+    timings stay comparable with a real bus. on_frame, when set, is called
+    with each command and the time it was put on the bus.
+    """
+
+    def __init__(self, lamps=DEFAULT_DALI_LAMPS, frame_time=SIMULATOR_FRAME_TIME):
+        self.gear = {x: SimulatedGear(x) for x in range(lamps)}
+        self.frame_time = frame_time
+        self.on_frame = None
+        self.frames = 0
+        self._dtr0 = 0
+        self._lock = threading.Lock()
+
+    def _addressed(self, destination):
+        if isinstance(destination, address.Short):
+            gears = [self.gear.get(destination.address)]
+        elif isinstance(destination, address.Group):
+            gears = [x for x in self.gear.values() if x.groups & (1 << destination.group)]
+        elif isinstance(destination, address.Broadcast):
+            gears = list(self.gear.values())
+        else:
+            gears = []
+        return [x for x in gears if x is not None and x.alive]
+
+    def send(self, command):
+        with self._lock:
+            self.frames += 1
+            if self.on_frame is not None:
+                self.on_frame(command, time.monotonic())
+            time.sleep(self.frame_time * (2 if command.sendtwice else 1))
+
+            if isinstance(command, gear.DTR0):
+                self._dtr0 = command.param
+                return None
+            gears = self._addressed(getattr(command, "destination", None))
+            if command.response is None:
+                for _x in gears:
+                    self._apply(_x, command)
+                return None
+
+            answers = [x for x in (self._answer(_x, command) for _x in gears) if x is not None]
+            if not answers:
+                return command.response(None)
+            time.sleep(self.frame_time / 2)
+            if len(answers) > 1:
+                return command.response(BackwardFrameError(255))
+            return command.response(BackwardFrame(answers[0]))
+
+    def send_many(self, commands):
+        return [self.send(command) for command in commands]
+
+    def _apply(self, _x, command):
+        if isinstance(command, gear.DAPC):
+            _x.set_level(command.power)
+        elif isinstance(command, gear.GoToScene):
+            _x.set_level(_x.scenes[command.param])
+        elif isinstance(command, gear.RecallMaxLevel):
+            _x.set_level(_x.max_level)
+        elif isinstance(command, gear.RecallMinLevel):
+            _x.set_level(_x.min_level)
+        elif isinstance(command, gear.Off):
+            _x.set_level(0)
+        elif isinstance(command, gear.SetFadeTime):
+            _x.fade_time = self._dtr0 & 0x0f
+
+    @staticmethod
+    def _answer(_x, command):
+        """Answer of one gear to a query, None for no answer."""
+        yes = 0xff
+        if isinstance(command, gear.QueryControlGearPresent):
+            return yes
+        if isinstance(command, gear.QuerySceneLevel):
+            return _x.scenes[command.param]
+        if isinstance(command, gear.QueryPhysicalMinimum):
+            return _x.physical_minimum
+        if isinstance(command, gear.QueryMinLevel):
+            return _x.min_level
+        if isinstance(command, gear.QueryMaxLevel):
+            return _x.max_level
+        if isinstance(command, gear.QueryActualLevel):
+            return _x.level
+        if isinstance(command, gear.QueryFadeTimeFadeRate):
+            return (_x.fade_time << 4) | _x.fade_rate
+        if isinstance(command, gear.QueryGroupsZeroToSeven):
+            return _x.groups & 0xff
+        if isinstance(command, gear.QueryGroupsEightToFifteen):
+            return _x.groups >> 8
+        if isinstance(command, gear.QueryLampPowerOn):
+            return yes if _x.level > 0 else None
+        if isinstance(command, gear.QueryLampFailure):
+            return yes if _x.lamp_failure else None
+        if isinstance(command, gear.QueryPowerFailure):
+            return yes if _x.power_failure else None
+        if isinstance(command, gear.QueryStatus):
+            return (_x.lamp_failure << 1) | ((_x.level > 0) << 2) | (_x.power_failure << 7)
+        logger.debug("Simulated gear %d ignores %s", _x.address, command)
+        return None
@@ -0,0 +1,96 @@
+"""Whole bus inventory and state, each on a single retained topic."""
+import json
+import threading
+import time
+
+from .config import Config
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+def _compact(document):
+    return json.dumps(document, separators=(",", ":"))
+
+
+class Snapshot:
+    """Publish the inventory of the bus and a snapshot of its state.
+
+    The inventory is published when the bus was scanned or lights were
+    renamed. The state snapshot maps every lamp and group address to
+    [brightness, scene], and is published SNAPSHOT_DEBOUNCE seconds after
+    the first of a burst of changes, with a sequence number. With
+    state_deltas, only the changed entries are also published (not
+    retained) on the delta topic, null for removed ones.
+    """
+
+    def __init__(self, data_object, client):
+        self.config = Config()
+        logger.setLevel(ALL_SUPPORTED_LOG_LEVELS[self.config[CONF_LOG_LEVEL]])
+
+        self.data_object = data_object
+        self.client = client
+        self.seq = 0
+        self._state = None
+        self._changed = threading.Event()
+        threading.Thread(target=self._run, name="snapshot", daemon=True).start()
+
+    def publish_inventory(self):
+        lamps = self.data_object["all_lamps"]
+        groups = self.data_object["all_groups"]
+        inventory = {
+            "lamps": [
+                {
+                    "address": _x.address,
+                    "name": _x.friendly_name,
+                    "physical_minimum": _x.min_physical_level,
+                    "min_level": _x.min_level,
+                    "max_level": _x.max_level,
+                    "fade_time": _x.default_fade_time,
+                    "scenes": _x.scenes,
+                    "groups": [group.address for group in _x.groups],
+                }
+                for _x in list(lamps.values())
+            ],
+            "groups": [
+                {"address": _x.address, "name": _x.friendly_name, "lamps": [lamp.address for lamp in _x.lamps]}
+                for _x in list(groups.values())
+            ],
+        }
+        self.client.publish(
+            MQTT_BRIDGE_DEVICES_TOPIC.format(self.config[CONF_MQTT_BASE_TOPIC]), _compact(inventory), retain=True
+        )
+
+    def changed(self):
+        self._changed.set()
+
+    def _run(self):
+        while True:
+            self._changed.wait()
+            time.sleep(SNAPSHOT_DEBOUNCE)
+            self._changed.clear()
+            try:
+                self._publish_state()
+            except Exception as err:
+                logger.error(f"Failed to publish the state snapshot: {err}")
+
+    def _publish_state(self):
+        state = {
+            kind: {str(_x.address): [_x.level, _x.current_scene] for _x in list(self.data_object[key].values())}
+            for kind, key in (("lamps", "all_lamps"), ("groups", "all_groups"))
+        }
+        if state == self._state:
+            return
+        self.seq += 1
+        base_topic = self.config[CONF_MQTT_BASE_TOPIC]
+        if self.config[CONF_STATE_DELTAS] and self._state is not None:
+            delta = {"seq": self.seq}
+            for kind in ("lamps", "groups"):
+                old, new = self._state[kind], state[kind]
+                delta[kind] = {key: value for key, value in new.items() if old.get(key) != value}
+                delta[kind].update({key: None for key in old if key not in new})
+            self.client.publish(MQTT_BRIDGE_STATE_DELTA_TOPIC.format(base_topic), _compact(delta))
+        self.client.publish(MQTT_BRIDGE_STATE_TOPIC.format(base_topic), _compact({"seq": self.seq, **state}),
+                            retain=True)
+        self._state = state
@@ -0,0 +1,70 @@
+"""Timings of the bridge startup."""
+import json
+import threading
+import time
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+class StartupProfile:
+    """Record how long each startup phase took, from the start of the process.
+
+    Phases run partly in parallel (the scan runs while MQTT keeps serving, and
+    ends after the bridge went online), so each one is recorded with its own
+    start and duration. Only the first run of a phase is kept, rescans and
+    reconnects later on don't belong to the startup.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(StartupProfile, cls).__new__(cls)
+            cls._instance.start = time.monotonic()
+            cls._instance.phases = []
+            cls._instance._begun = {}
+            cls._instance.enabled = False
+            cls._instance.online_after = None
+            cls._instance.online = threading.Event()
+        return cls._instance
+
+    def record(self, name, started):
+        """Record a phase which started at monotonic time started and ends now."""
+        if any(_x[0] == name for _x in self.phases):
+            return
+        self.phases.append((name, started - self.start, time.monotonic() - started))
+        if self.enabled and self.online_after is not None:
+            self._log(*self.phases[-1])
+
+    def begin(self, name):
+        """Start a phase which ends in another part of the code, see end()."""
+        self._begun.setdefault(name, time.monotonic())
+
+    def end(self, name):
+        if name in self._begun:
+            self.record(name, self._begun.pop(name))
+
+    def online_now(self):
+        """Mark the bridge online, and report the timings the first time."""
+        if self.online_after is not None:
+            return
+        self.online_after = time.monotonic() - self.start
+        self.online.set()
+        if self.enabled:
+            logger.setLevel(logging.INFO)
+            logger.info("Startup profile:")
+            for phase in self.phases:
+                self._log(*phase)
+            logger.info(f"   - online after {self.online_after:.3f}s")
+
+    @staticmethod
+    def _log(name, offset, duration):
+        logger.info(f"   - {name:<14} at {offset:7.3f}s took {duration:7.3f}s")
+
+    def as_json(self):
+        return json.dumps({
+            "phases": [{"name": name, "at": offset, "duration": duration} for name, offset, duration in self.phases],
+            "online_after": self.online_after,
+        })
@@ -0,0 +1,163 @@
+"""Bus timing tuned from the latencies measured on the adapter."""
+import time
+
+import dali.address as address
+from dali.frame import BackwardFrameError
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+TIMING_SEND = "send"
+TIMING_ANSWER = "answer"
+TIMING_NO_ANSWER = "no_answer"
+
+
+class _Latency:
+    """Smoothed latency and its variation, as TCP estimates its round trip time."""
+
+    def __init__(self):
+        self.mean = None
+        self.deviation = 0.0
+        self.samples = 0
+
+    def add(self, sample):
+        self.samples += 1
+        if self.mean is None:
+            self.mean, self.deviation = sample, sample / 2
+        else:
+            self.deviation += (abs(self.mean - sample) - self.deviation) / 4
+            self.mean += (sample - self.mean) / 8
+
+    @property
+    def bound(self):
+        return self.mean + 4 * self.deviation
+
+
+def _kind(command, response):
+    if command.response is None:
+        return TIMING_SEND
+    if response is None or response.raw_value is None:
+        return TIMING_NO_ANSWER
+    return TIMING_ANSWER
+
+
+def _frame_error(command, response):
+    """A garbled answer from a single gear, colliding answers of groups and broadcasts are expected."""
+    return (
+        response is not None
+        and isinstance(response.raw_value, BackwardFrameError)
+        and isinstance(getattr(command, "destination", None), address.Short)
+    )
+
+
+class BusTiming:
+    """Deadline and pacing of the bus transactions, adapted to the adapter.
+
+    The latency per frame is measured for each kind: commands, answered
+    queries and queries without answer, which last as long as the adapter
+    waits for an answer, from the transactions made of a single kind. Once
+    BUS_TIMING_MIN_SAMPLES were measured, the deadline per frame shrinks by
+    BUS_TIMING_TIMEOUT_STEP per clean transaction down to
+    BUS_TIMING_TIMEOUT_FACTOR times the slowest kind, never below
+    BUS_TIMING_MIN_TIMEOUT nor above max_timeout, and is multiplied by
+    BUS_TIMING_BACKOFF when it was missed. misses counts the deadlines
+    missed in a row.
+    The gap left between transactions is doubled on every garbled answer,
+    up to BUS_TIMING_MAX_GAP, and shrinks by BUS_TIMING_GAP_STEP after each
+    BUS_TIMING_CLEAN_FRAMES frames without one.
+    """
+
+    def __init__(self, max_timeout):
+        self.max_timeout = max_timeout
+        self.timeout = max_timeout
+        self.gap = 0.0
+        self.frame_errors = 0
+        self.misses = 0
+        self.missed = 0
+        self.latency = {TIMING_SEND: _Latency(), TIMING_ANSWER: _Latency(), TIMING_NO_ANSWER: _Latency()}
+        self._clean = 0
+        self._last_end = 0.0
+        self._reported = None
+        self._next_report = 0.0
+
+    def deadline(self, commands):
+        return self.timeout * sum(2 if command.sendtwice else 1 for command in commands)
+
+    def pace(self):
+        """Wait for the gap since the end of the last transaction."""
+        wait = self._last_end + self.gap - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def record(self, commands, responses, duration):
+        """Learn from a transaction which ended normally, responses in the order of commands."""
+        self._last_end = time.monotonic()
+        self.misses = 0
+        errors = sum(_frame_error(*_x) for _x in zip(commands, responses))
+        kinds = {_kind(*_x) for _x in zip(commands, responses)}
+        if len(kinds) == 1 and not errors:
+            # Frames of a batch overlap, but the deadline is per frame of the batch as well
+            self.latency[kinds.pop()].add(duration / sum(2 if _x.sendtwice else 1 for _x in commands))
+        if errors:
+            self.frame_error(errors)
+        else:
+            self._clean += len(commands)
+            if self._clean >= BUS_TIMING_CLEAN_FRAMES:
+                self._clean = 0
+                self.gap = max(self.gap - BUS_TIMING_GAP_STEP, 0.0)
+        self._tune_timeout()
+
+    def frame_error(self, count=1):
+        self._last_end = time.monotonic()
+        self.misses = 0
+        self.frame_errors += count
+        self._clean = 0
+        previous, self.gap = self.gap, min(max(self.gap * 2, BUS_TIMING_GAP_STEP), BUS_TIMING_MAX_GAP)
+        if self.gap != previous:
+            logger.debug(f"Frame error, {self.gap * 1000:.0f} ms left between transactions")
+
+    def timed_out(self):
+        self.misses += 1
+        self.missed += 1
+        self.timeout = min(self.timeout * BUS_TIMING_BACKOFF, self.max_timeout)
+        self._clean = 0
+        logger.info(f"Transaction deadline raised to {self.timeout:.2f}s")
+
+    def _tune_timeout(self):
+        measured = [_x.bound for _x in self.latency.values() if _x.samples]
+        if sum(_x.samples for _x in self.latency.values()) < BUS_TIMING_MIN_SAMPLES:
+            target = self.max_timeout
+        else:
+            target = min(max(BUS_TIMING_TIMEOUT_FACTOR * max(measured), BUS_TIMING_MIN_TIMEOUT), self.max_timeout)
+        if target >= self.timeout:
+            self.timeout = target
+        else:
+            self.timeout = max(self.timeout - BUS_TIMING_TIMEOUT_STEP, target)
+
+    def status(self):
+        def milliseconds(latency):
+            return None if latency.mean is None else round(latency.mean * 1000, 1)
+
+        return {
+            "rtt_ms": milliseconds(self.latency[TIMING_ANSWER]),
+            "no_answer_ms": milliseconds(self.latency[TIMING_NO_ANSWER]),
+            "send_ms": milliseconds(self.latency[TIMING_SEND]),
+            "timeout": round(self.timeout, 3),
+            "gap_ms": round(self.gap * 1000, 1),
+            "frame_errors": self.frame_errors,
+            "missed": self.missed,
+        }
+
+    def report(self):
+        """The status when it changed since the last report, at most every BUS_TIMING_REPORT_INTERVAL seconds."""
+        now = time.monotonic()
+        if now < self._next_report:
+            return None
+        status = self.status()
+        if status == self._reported:
+            return None
+        self._reported = status
+        self._next_report = now + BUS_TIMING_REPORT_INTERVAL
+        return status
@@ -0,0 +1,123 @@
+"""State published once per topic for each command."""
+import itertools
+import threading
+from contextlib import contextmanager
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+# Changes of the state are applied one at a time, whichever thread they come from
+_lock = threading.RLock()
+# Last write of each topic still to be published, a transaction only publishes the topics it wrote last
+_writes = itertools.count()
+_latest = {}
+
+
+@contextmanager
+def transaction():
+    """Collect the state the current thread publishes, and publish each topic once with its final value.
+
+    Nested transactions are part of the outermost one, and transactions of
+    different threads change the state one after the other, see unlocked()
+    for their waits. The state is published even when applying the command
+    failed halfway, as far as it got.
+    """
+    if getattr(_local, "pending", None) is not None:
+        yield
+        return
+    with _lock:
+        _local.pending = pending = {}
+        try:
+            yield
+        finally:
+            _local.pending = None
+            for topic, (publisher, payload, qos, retain, properties, write) in pending.items():
+                # A transaction which ran while this one waited changed the topic again
+                if _latest.get(topic) != write:
+                    continue
+                del _latest[topic]
+                publisher.publish_now(topic, payload, qos, retain, properties)
+
+
+@contextmanager
+def unlocked():
+    """Let the transactions of other threads run while the current one waits, e.g. for the bus.
+
+    The state may change meanwhile, what the current transaction wrote is
+    only published if it wasn't written again.
+    """
+    pending = getattr(_local, "pending", None)
+    if pending is None:
+        yield
+        return
+    _local.pending = None
+    _lock.release()
+    try:
+        yield
+    finally:
+        _lock.acquire()
+        _local.pending = pending
+
+
+class StatePublisher:
+    """Client whose retained state publishes are deferred while a transaction() is running.
+
+    Everything else is passed on to the wrapped MQTT client. listeners are
+    called with the topic and payload of everything actually published.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.listeners = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        pending = getattr(_local, "pending", None)
+        if pending is None or not retain:
+            if retain:
+                _latest.pop(topic, None)
+            return self.publish_now(topic, payload, qos, retain, properties)
+        # The topic keeps the position of its first write, with the last value
+        write = next(_writes)
+        _latest[topic] = write
+        pending[topic] = (self, payload, qos, retain, properties, write)
+
+    def publish_now(self, topic, payload=None, qos=0, retain=False, properties=None):
+        info = self.client.publish(topic, payload, qos, retain, properties)
+        for listener in self.listeners:
+            listener(topic, payload)
+        return info
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class DeferredPublisher:
+    """Client holding the retained state back until flush(), e.g. of lights not in service yet.
+
+    Each topic is published once with its last value, in the order of the
+    first writes. After flush() everything is passed on at once.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        with self._lock:
+            if self._pending is not None and retain:
+                self._pending[topic] = (payload, qos, retain, properties)
+                return None
+        return self.client.publish(topic, payload, qos, retain, properties)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, None
+        for topic, (payload, qos, retain, properties) in (pending or {}).items():
+            self.client.publish(topic, payload, qos, retain, properties)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
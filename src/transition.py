@@ -0,0 +1,78 @@
+"""Transitions using the fade time of the DALI gear."""
+import math
+import threading
+import time
+
+from .consts import *
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+# Duration in seconds of each DALI fade time setting (IEC 62386-102), 0 means no fade
+FADE_TIMES = [0] + [0.5 * math.sqrt(2 ** x) for x in range(1, 16)]
+
+
+def fade_time_for(transition):
+    """Return the DALI fade time setting closest to a transition in seconds."""
+    return min(range(len(FADE_TIMES)), key=lambda x: abs(FADE_TIMES[x] - transition))
+
+
+class RampPublisher:
+    """Publish the predicted level of lights while the gear fades.
+
+    The gear fades on its own after a single DAPC, this only walks the
+    published brightness along the same linear ramp so no polling is needed.
+    Starting a ramp for a light replaces the one already running.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(RampPublisher, cls).__new__(cls)
+            cls._instance._cond = threading.Condition()
+            cls._instance._ramps = {}
+            cls._instance._thread = None
+        return cls._instance
+
+    def start(self, key, start_level, target_level, duration, step, done):
+        """Ramp from start_level to target_level, calling step(level) on the way and done() at the end."""
+        with self._cond:
+            running = self._ramps.get(key)
+            if running is not None:
+                start_level = self._predict(running, time.monotonic())
+            self._ramps[key] = (start_level, target_level, time.monotonic(), duration, step, done)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="dali-ramps", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._ramps.pop(key, None)
+
+    @staticmethod
+    def _predict(ramp, now):
+        start_level, target_level, started, duration, _, _ = ramp
+        progress = min((now - started) / duration, 1) if duration > 0 else 1
+        return round(start_level + (target_level - start_level) * progress)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ramps:
+                    self._cond.wait()
+                now = time.monotonic()
+                steps = []
+                for key, ramp in list(self._ramps.items()):
+                    if now - ramp[2] >= ramp[3]:
+                        del self._ramps[key]
+                        steps.append((ramp[5], ()))
+                    else:
+                        steps.append((ramp[4], (self._predict(ramp, now),)))
+
+            for callback, args in steps:
+                try:
+                    callback(*args)
+                except Exception as err:
+                    logger.error("While publishing transition: %s", err)
+            time.sleep(TRANSITION_STEP_INTERVAL)
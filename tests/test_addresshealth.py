@@ -0,0 +1,46 @@
+"""AddressHealth backoff and quarantine."""
+import time
+import unittest
+from unittest import mock
+
+from src.addresshealth import AddressHealth
+from src.config import Config
+from src.consts import ADDRESS_BACKOFF_BASE, ADDRESS_BACKOFF_MAX, ADDRESS_QUARANTINE_FAILURES
+
+
+class AddressHealthTest(unittest.TestCase):
+    def setUp(self):
+        Config().setup({})
+        AddressHealth._instance = None
+        self.health = AddressHealth()
+
+    def tearDown(self):
+        AddressHealth._instance = None
+
+    def backoff_after(self, failures):
+        now = time.monotonic()
+        with mock.patch("src.addresshealth.time.monotonic", return_value=now):
+            for _ in range(failures):
+                self.health.failed(3)
+        return self.health._failures[3][1] - now
+
+    def test_backs_off_exponentially(self):
+        self.assertEqual(self.backoff_after(1), ADDRESS_BACKOFF_BASE)
+        self.assertEqual(self.backoff_after(1), ADDRESS_BACKOFF_BASE * 2)
+        self.assertFalse(self.health.quarantined(3))
+
+    def test_quarantine_waits_the_longest_backoff(self):
+        self.assertEqual(self.backoff_after(ADDRESS_QUARANTINE_FAILURES), ADDRESS_BACKOFF_MAX)
+        self.assertTrue(self.health.quarantined(3))
+        self.assertFalse(self.health.available(3))
+
+    def test_an_answer_resets_the_address(self):
+        self.backoff_after(ADDRESS_QUARANTINE_FAILURES)
+        self.health.succeeded(3)
+        self.assertTrue(self.health.available(3))
+        self.assertFalse(self.health.quarantined(3))
+        self.assertEqual(self.backoff_after(1), ADDRESS_BACKOFF_BASE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""PersistentDaliServer against a local stand-in for daliserver."""
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import dali.address as address
+import dali.gear.general as gear
+
+from src.daliserver import PersistentDaliServer
+
+
+class FakeDaliServer:
+    """Answer every 4 byte request with a 4 byte response, unless silent."""
+
+    def __init__(self):
+        self.silent = False
+        self.frames = 0
+        self.connections = []
+        self._server = socket.create_server(("127.0.0.1", 0))
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            self.connections.append(connection)
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        try:
+            while True:
+                data = connection.recv(4)
+                if not data:
+                    return
+                self.frames += 1
+                if not self.silent:
+                    connection.sendall(struct.pack("BBBB", 2, 0, 0, 0))
+        except OSError:
+            return
+
+    def close(self):
+        self._server.close()
+        for connection in self.connections:
+            connection.close()
+
+
+class PersistentDaliServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeDaliServer()
+        self.driver = PersistentDaliServer("127.0.0.1", self.server.port, 2.0)
+
+    def tearDown(self):
+        self.driver.close()
+        self.server.close()
+
+    def test_keeps_the_connection_open(self):
+        started = time.monotonic()
+        for level in range(20):
+            self.driver.send(gear.DAPC(address.Short(1), level))
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(self.server.frames, 20)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_reconnects_when_the_server_closed_the_idle_connection(self):
+        self.driver.send(gear.DAPC(address.Short(1), 1))
+        self.server.connections[0].shutdown(socket.SHUT_RDWR)
+        time.sleep(0.1)
+        self.driver.send(gear.DAPC(address.Short(1), 2))
+        self.assertEqual(self.server.frames, 2)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_does_not_send_again_after_a_timeout(self):
+        self.driver.timeout = 0.3
+        self.driver.send(gear.DAPC(address.Short(1), 1))
+        self.driver._s.settimeout(0.3)
+        self.server.silent = True
+        with self.assertRaises(OSError):
+            self.driver.send(gear.DAPC(address.Short(1), 2))
+        time.sleep(0.2)
+        self.assertEqual(self.server.frames, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
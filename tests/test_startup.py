@@ -0,0 +1,38 @@
+"""StartupProfile phases."""
+import json
+import time
+import unittest
+
+from src.startup import StartupProfile
+
+
+class StartupProfileTest(unittest.TestCase):
+    def setUp(self):
+        StartupProfile._instance = None
+        self.profile = StartupProfile()
+
+    def tearDown(self):
+        StartupProfile._instance = None
+
+    def phases(self):
+        return [_x["name"] for _x in json.loads(self.profile.as_json())["phases"]]
+
+    def test_records_the_scan_after_online(self):
+        started = time.monotonic()
+        self.profile.record("setup", started)
+        self.profile.online_now()
+        self.profile.record("scan", started)
+        self.assertEqual(self.phases(), ["setup", "scan"])
+        self.assertIsNotNone(json.loads(self.profile.as_json())["online_after"])
+
+    def test_keeps_the_first_run_of_a_phase(self):
+        self.profile.begin("mqtt connect")
+        self.profile.end("mqtt connect")
+        self.profile.online_now()
+        self.profile.begin("mqtt connect")
+        self.profile.end("mqtt connect")
+        self.assertEqual(self.phases(), ["mqtt connect"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""State transactions of concurrent threads."""
+import threading
+import unittest
+
+from src.transaction import StatePublisher, transaction, unlocked
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published.append((topic, payload))
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.client = RecordingClient()
+        self.publisher = StatePublisher(self.client)
+
+    def test_publishes_each_topic_once(self):
+        with transaction():
+            self.publisher.publish("a", "1", retain=True)
+            self.publisher.publish("b", "1", retain=True)
+            self.publisher.publish("a", "2", retain=True)
+            self.assertEqual(self.client.published, [])
+        self.assertEqual(self.client.published, [("a", "2"), ("b", "1")])
+
+    def test_other_threads_run_while_waiting(self):
+        waiting, done = threading.Event(), threading.Event()
+
+        def other():
+            waiting.wait()
+            with transaction():
+                self.publisher.publish("a", "other", retain=True)
+            done.set()
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        with transaction():
+            self.publisher.publish("a", "first", retain=True)
+            self.publisher.publish("b", "first", retain=True)
+            with unlocked():
+                waiting.set()
+                self.assertTrue(done.wait(5))
+        thread.join()
+        # The later write of the other thread is the state, it isn't overwritten with the older one
+        self.assertEqual(self.client.published, [("a", "other"), ("b", "first")])
+
+    def test_waits_for_the_transaction_of_another_thread(self):
+        started = threading.Event()
+        order = []
+
+        def other():
+            started.wait()
+            with transaction():
+                order.append("other")
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        with transaction():
+            started.set()
+            thread.join(0.2)
+            order.append("first")
+        thread.join()
+        self.assertEqual(order, ["first", "other"])
+
+
+if __name__ == "__main__":
+    unittest.main()